@@ -1,127 +1,589 @@
 #!/usr/bin/env python3
 import datetime
+import gzip
 import json
 import os
+import random
+import re
+import signal
 import time
 import sys
+import threading
+from abc import ABC, abstractmethod
 from base64 import b64decode
-from collections import namedtuple
-from contextlib import suppress
-from hashlib import md5
+from codecs import getincrementaldecoder
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait)
+from contextlib import contextmanager, suppress
+from hashlib import md5, sha256
+from html.parser import HTMLParser
 from traceback import print_exc
 
-from bs4 import BeautifulSoup
-import phpserialize
-import requests
+# The heavy dependencies (bs4, phpserialize, requests) and the asyncio,
+# http.server and sqlite3 modules are imported where they are used, so the
+# tests, replaying and one-shot modes start quickly.
 
 
 KLANT_NUMMER = os.environ.get('KLANT_NUMMER')
 KLANT_CODE = os.environ.get('KLANT_CODE', '')
-KLANT_GECRYPT = md5(KLANT_CODE.encode('ascii')).hexdigest()
 
 SLACK_API_BEARER = os.environ.get('SLACK_API_BEARER')  # xoxb-...
 SLACK_API_USERS_LIST = 'https://slack.com/api/users.list'
-SLACK_NO_MENTION_USERS = os.environ.get('SLACK_NO_MENTION_USERS', '').split()
+SLACK_NO_MENTION_USERS = frozenset(
+    os.environ.get('SLACK_NO_MENTION_USERS', '').split())
 SLACK_WEBHOOK_URL = os.environ.get('SLACK_WEBHOOK_URL')
+# Optional extra outputs (sinks), see make_sinks().
+SLACK_CHANNEL_WEBHOOK_URL = os.environ.get('SLACK_CHANNEL_WEBHOOK_URL', '')
+JSONL_FILE = os.environ.get('JSONL_FILE', '')  # or '-' for stdout
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+SYSLOG_ADDRESS = os.environ.get('SYSLOG_ADDRESS', '')  # /dev/log, host:port
 CACHE_FILENAME = (__file__.rsplit('.py', 1)[0] + '.cache')
+SLACK_USERMAP_CACHE = os.environ.get(
+    'SLACK_USERMAP_CACHE', __file__.rsplit('.py', 1)[0] + '.usermap.json')
+SLACK_USERMAP_TTL = 86400
+SLACK_USERMAP_REFRESH = 6 * 3600
 
-ALERTMOBILE_URL = 'https://alertmobile.alert-group.nl/koi_kb.php'
+ALERTMOBILE_URL = os.environ.get(
+    'ALERTMOBILE_URL', 'https://alertmobile.alert-group.nl/koi_kb.php')
+PORTAL_READ_CHUNK = 8192
+# Bytes we read on after the history table, so the keep-alive connection
+# can be reused. If more is coming, we hang up instead.
+PORTAL_DRAIN_MAX = 16384
 MAX_FAIL_TIME = 1800
 SLEEP_AFTER_FETCH = 300
 SLEEP_AFTER_FAIL = 180
+# Failed polls are retried with exponential backoff (and jitter): from
+# RETRY_BACKOFF_MIN up to SLEEP_AFTER_FAIL for network errors, from
+# SLEEP_AFTER_FAIL up to CIRCUIT_OPEN_TIME for login and parse errors
+# (retrying those soon rarely helps). After CIRCUIT_MAX_FAILURES
+# network/login failures in a row the circuit opens: we post a notice to
+# Slack and only probe the portal after CIRCUIT_OPEN_TIME, doubling up
+# to MAX_FAIL_TIME while the probes fail. Parse errors are our problem,
+# not the portal's: they are logged loudly, but do not open the circuit.
+# When all accounts have been failing (for any reason) for longer than
+# MAX_FAIL_TIME, we exit non-zero, for the supervisor to restart us.
+RETRY_BACKOFF_MIN = 15
+CIRCUIT_MAX_FAILURES = 5
+CIRCUIT_OPEN_TIME = 600
+# Adaptive polling: poll every POLL_INTERVAL_MIN seconds for
+# POLL_ACTIVE_PERIOD after alarm activity, then back off to
+# SLEEP_AFTER_FETCH, or towards POLL_INTERVAL_MAX during the night.
+POLL_INTERVAL_MIN = int(os.environ.get('POLL_INTERVAL_MIN', '20'))
+POLL_INTERVAL_MAX = int(os.environ.get('POLL_INTERVAL_MAX', '600'))
+POLL_ACTIVE_PERIOD = 1800
+POLL_NIGHT_HOURS = (0, 6)  # [start, end) in localtime
+POLL_JITTER = 0.1  # +/- fraction of the interval
 SLACK_DOTDOT_BUG_WORKAROUND = False
+SLACK_MAX_MESSAGE_LENGTH = 3000  # max. text length of a section block
+SLACK_MAX_ATTEMPTS = 5
 
 SLACK_USERMAP = {'alice': 'U0H87MYTC', 'frank': 'U025CBXTP'}
 
 HEALTH_FILE = os.environ.get('HEALTH_FILE', '')
+HEALTH_MAX_AGE = 900
+METRICS_PORT = os.environ.get('METRICS_PORT', '')
+METRICS_STARTED = time.time()
+ACCOUNTS_FILE = os.environ.get('ACCOUNTS_FILE', '')
+POLL_WORKERS = int(os.environ.get('POLL_WORKERS', '4'))
+LEDGER_FILE = os.environ.get('LEDGER_FILE', '')
+HISTORY_DB = os.environ.get('HISTORY_DB', '')
+ANALYTICS_FILE = os.environ.get('ANALYTICS_FILE', '')
+DIGEST_PERIOD = os.environ.get('DIGEST_PERIOD', 'weekly')  # daily/weekly/''
+DIGEST_GRACE = 1800  # wait this long for late records before a digest
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', '')
+SNAPSHOT_MAX_AGE = 90 * 86400
+SNAPSHOT_MAX_BYTES = 100 * 1024 * 1024
+PUBLISH_LOOKBACK = datetime.timedelta(hours=4)
 
 
-class AlarmRecord(
-        namedtuple('AlarmRecord', 'datetime event group sector extra')):
+_EPOCH = datetime.datetime(2000, 1, 1)
+_SECOND = datetime.timedelta(seconds=1)
+
+# The rewrites of the extra info in AlarmRecord.__str__, per event: the
+# first group of the regex is the username, which becomes 'by <mention>'.
+# Arming/disarming is "VOLL. ING BOB (In)" or, since 2024-12-10,
+# "VOLL. ING BOB (18:55 In)".
+_USERNAME_RULES = {
+    'ALARM_ON': re.compile(r'VOLL\. ING (.*) \((?:.{5} )?In\)', re.S),
+    'ALARM_OFF': re.compile(r'UITGESCH\. (.*) \((?:.{5} )?Uit\)', re.S),
+}
+_INFO_RULES = {
+    '24H': {'AUTOTEST (Test)': '(autotest)'},
+}
+
+
+class SlackMentions:
+    """
+    Memo of username -> Slack mention: <@ID> from the SLACK_USERMAP, or
+    the username itself (SLACK_NO_MENTION_USERS, unknown users).
+
+    It remembers the SLACK_USERMAP and SLACK_NO_MENTION_USERS it was
+    filled from, and starts over when another one is assigned. Changes
+    made in place go unnoticed: call clear() after those.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # (mentions, usermap, no mention users, as a set), swapped in one
+        # go, as the poll threads use it concurrently.
+        self._state = ({}, None, None, frozenset())
+
+    def get(self, username):
+        mentions, usermap, no_mention, no_mention_set = self._state
+        if usermap is not SLACK_USERMAP or (
+                no_mention is not SLACK_NO_MENTION_USERS):
+            mentions, usermap, no_mention, no_mention_set = self._state = (
+                {}, SLACK_USERMAP, SLACK_NO_MENTION_USERS,
+                frozenset(SLACK_NO_MENTION_USERS))
+        try:
+            return mentions[username]
+        except KeyError:
+            pass
+
+        mention = username
+        if username not in no_mention_set:
+            slack_userid = usermap.get(username.lower())
+            if slack_userid:
+                mention = f'<@{slack_userid}>'
+        mentions[username] = mention
+        return mention
+
+
+MENTIONS = SlackMentions()
+
+
+class AlarmRecord:
+    """
+    A single alarm event: AlarmRecord(datetime, event, group, sector, extra)
+
+    We keep many of these around (per account), so they are compact:
+    no __dict__, the (TZ agnostic) datetime is stored as integer seconds
+    since 2000 (the portal has no sub-second times: microseconds are
+    dropped) and the repetitive event, group and sector strings are
+    interned. The datetime property builds a new datetime every time, so
+    the hot paths compare timestamps instead (see to_timestamp()).
+
+    They are hashed, so they are immutable: setting an attribute after
+    __init__ raises AttributeError.
+    """
+    __slots__ = ('timestamp', 'event', 'group', 'sector', 'extra')
+    _fields = ('datetime', 'event', 'group', 'sector', 'extra')
+
     NORMAL_EVENTS = ('ALARM_ON', 'ALARM_OFF', '24H', 'OVERRIDE_ALARM_TIME')
+    _NORMAL_EVENTS = frozenset(NORMAL_EVENTS)
+
+    def __init__(self, datetime, event, group, sector, extra):
+        init = object.__setattr__
+        init(self, 'timestamp', AlarmRecord.to_timestamp(datetime))
+        init(self, 'event', sys.intern(event))
+        init(self, 'group', sys.intern(group))
+        init(self, 'sector', sys.intern(sector))
+        init(self, 'extra', extra)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
+
+    @staticmethod
+    def to_timestamp(dt):
+        """
+        The timestamp of a datetime, to compare with record.timestamp.
+        """
+        return (dt - _EPOCH) // _SECOND
 
     @staticmethod
     def SORT_KEY(record):
-        return (record.datetime, record.event)
+        # Same order as (record.datetime, record.event).
+        return (record.timestamp, record.event)
+
+    @property
+    def datetime(self):
+        return _EPOCH + datetime.timedelta(seconds=self.timestamp)
+
+    def _key(self):
+        return (self.timestamp, self.event, self.group, self.sector,
+                self.extra)
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __reduce__(self):
+        # Unpickle through __init__, so the strings get interned again.
+        return (self.__class__, (
+            self.datetime, self.event, self.group, self.sector, self.extra))
+
+    def _asdict(self):
+        return dict((i, getattr(self, i)) for i in self._fields)
 
     @property
     def datetime_str(self):
         return self.datetime.strftime('%Y-%m-%d %H:%M:%S')
 
+    @property
+    def username(self):
+        """
+        The (lowercase) user that armed/disarmed, or None.
+        """
+        rule = _USERNAME_RULES.get(self.event)
+        if rule is not None:
+            match = rule.fullmatch(self.extra)
+            if match is not None:
+                return match.group(1).lower()
+        return None
+
     @staticmethod
     def username_as_slack_mention(username):
-        if username in SLACK_NO_MENTION_USERS:
-            return username
-        slack_userid = SLACK_USERMAP.get(username.lower())
-        if not slack_userid:
-            return username
-        return f'<@{slack_userid}>'
+        return MENTIONS.get(username)
 
     def __str__(self):
-        message = (
-            '{0.datetime_str}: {0.event} (G{0.group}/S{0.sector})'
-            .format(self).rstrip())
+        event = self.event
         info = self.extra
 
-        if self.event == 'ALARM_ON' and info.startswith('VOLL. ING '):
-            if info.endswith(' (In)'):
-                username = self.username_as_slack_mention(info[10:-5].lower())
-                info = f'by {username}'
-            elif info.endswith(' In)') and info[-11:-9] == ' (':
-                username = self.username_as_slack_mention(info[10:-11].lower())
-                info = f'by {username}'
-
-        elif self.event == 'ALARM_OFF' and info.startswith('UITGESCH. '):
-            if info.endswith(' (Uit)'):
-                username = self.username_as_slack_mention(info[10:-6].lower())
-                info = f'by {username}'
-            elif info.endswith(' Uit)') and info[-12:-10] == ' (':
-                username = self.username_as_slack_mention(info[10:-12].lower())
-                info = f'by {username}'
-
-        elif self.event == '24H' and info == 'AUTOTEST (Test)':
-            info = '(autotest)'
-
-        elif self.event not in self.NORMAL_EVENTS:
+        rule = _USERNAME_RULES.get(event)
+        if rule is not None:
+            match = rule.fullmatch(info)
+            if match is not None:
+                info = 'by ' + self.username_as_slack_mention(
+                    match.group(1).lower())
+        elif event in _INFO_RULES:
+            info = _INFO_RULES[event].get(info, info)
+        elif event not in self._NORMAL_EVENTS:
             info += ' <-- <!channel>'  # slack notification
 
+        message = (
+            f'{self.datetime.isoformat(" ")}: {event} '
+            f'(G{self.group}/S{self.sector})')
         if info:
-            message += f': {info}'
-
+            return f'{message}: {info}'
         return message
 
     def __repr__(self):
         return f'<AlarmRecord{self._asdict()}>'
 
 
-def make_slack_usermap():
-    if not SLACK_API_BEARER:
-        print('no SLACK_API_BEARER token to get users.list')
-        return {}
+class Metrics:
+    """
+    Minimal thread-safe registry of Prometheus style counters, gauges and
+    histograms. render() returns them in the Prometheus text format.
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
 
-    ret = requests.get(
-        SLACK_API_USERS_LIST,
-        headers={'Authorization': f'Bearer {SLACK_API_BEARER}'},
-        timeout=10)
-    if ret.status_code != 200:
-        print(f'failed to get users.list: {ret}')
-        return {}
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> value
+        self.gauges = {}      # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts, sum, count]
 
-    try:
-        users_list = ret.json()
-    except Exception as e:
-        print(f'failed to parse users.list: {e}: {ret.text}')
-        return {}
-    try:
-        # usermap = dict((i['name'], i['id']) for i in users_list['members'])
-        usermap = dict(
-            (i['profile']['display_name'].lower(), i['id'])
-            for i in users_list['members'])
-    except Exception as e:
-        print(f'failed to parse users.list: {e}: {users_list}')
-        return {}
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def get(self, name, **labels):
+        key = self._key(name, labels)
+        return self.counters.get(key, self.gauges.get(key))
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            try:
+                histogram = self.histograms[key]
+            except KeyError:
+                histogram = self.histograms[key] = [
+                    [0] * len(self.BUCKETS), 0, 0]
+            for n, le in enumerate(self.BUCKETS):
+                if value <= le:
+                    histogram[0][n] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    @staticmethod
+    def _format(name, labels, value, extra_label=None):
+        if extra_label:
+            labels = labels + (extra_label,)
+        if labels:
+            name += '{%s}' % ','.join(f'{k}="{v}"' for k, v in labels)
+        return f'{name} {value}'
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for type_, metrics in (
+                    ('counter', self.counters), ('gauge', self.gauges)):
+                last_name = None
+                for (name, labels), value in sorted(metrics.items()):
+                    if name != last_name:
+                        lines.append(f'# TYPE {name} {type_}')
+                        last_name = name
+                    lines.append(self._format(name, labels, value))
+
+            last_name = None
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name != last_name:
+                    lines.append(f'# TYPE {name} histogram')
+                    last_name = name
+                bucket_counts, sum_, count = histogram
+                for le, bucket_count in zip(self.BUCKETS, bucket_counts):
+                    lines.append(self._format(
+                        f'{name}_bucket', labels, bucket_count, ('le', le)))
+                lines.append(self._format(
+                    f'{name}_bucket', labels, count, ('le', '+Inf')))
+                lines.append(self._format(f'{name}_sum', labels, sum_))
+                lines.append(self._format(f'{name}_count', labels, count))
+        return '\n'.join(lines) + '\n'
+
+    def latest(self, name):
+        """
+        The highest value of gauge name, over all labels, or None.
+        """
+        values = [
+            value for (name_, labels), value in list(self.gauges.items())
+            if name_ == name]
+        if not values:
+            return None
+        return max(values)
+
+    def last_success_age(self):
+        """
+        Seconds since the last successful poll of any account.
+        """
+        last_success = self.latest('log2slack_last_success_timestamp_seconds')
+        if last_success is None:
+            return None
+        return time.time() - last_success
+
+
+METRICS = Metrics()
+
+
+def health_check(now=None):
+    """
+    Returns (healthy, message). Healthy if an account was polled
+    successfully in the last HEALTH_MAX_AGE seconds, or if one is failing
+    and its retry (or circuit breaker probe) is not overdue by more than
+    HEALTH_MAX_AGE: a restart would not fix the portal, only lose the
+    state of the breaker. The outage shows in log2slack_circuit_open.
+    """
+    if now is None:
+        now = time.time()
+    last_success = METRICS.latest('log2slack_last_success_timestamp_seconds')
+    if last_success is None:
+        # Starting up: be healthy for the first HEALTH_MAX_AGE.
+        last_success = METRICS_STARTED
+    age = now - last_success
+    if age <= HEALTH_MAX_AGE:
+        return True, f'OK, last success {int(age)}s ago\n'
+    retry = METRICS.latest('log2slack_retry_timestamp_seconds')
+    if retry is not None and now - retry <= HEALTH_MAX_AGE:
+        return True, (
+            f'OK, failing, last success {int(age)}s ago, next retry '
+            f'{"in" if retry >= now else "due"} {int(abs(retry - now))}s\n')
+    return False, f'No updates in the last {int(age)}s\n'
 
-    return usermap
+
+def make_metrics_handler():
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """
+        Serves /metrics (Prometheus) and /healthz (see health_check()).
+        """
+        def do_GET(self):
+            if self.path == '/metrics':
+                age = METRICS.last_success_age()
+                if age is not None:
+                    METRICS.set('log2slack_last_success_age_seconds', age)
+                self.respond(200, METRICS.render())
+            elif self.path == '/healthz':
+                healthy, message = health_check()
+                self.respond(200 if healthy else 503, message)
+            else:
+                self.respond(404, 'Not found\n')
+
+        def respond(self, status, body):
+            body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+def start_metrics_server(port):
+    from http.server import ThreadingHTTPServer
+
+    global METRICS_STARTED
+    METRICS_STARTED = time.time()
+    server = ThreadingHTTPServer(('', port), make_metrics_handler())
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name='metrics', daemon=True).start()
+    print(f'# serving /metrics and /healthz on port {server.server_port}')
+    return server
+
+
+class SlackUsermap:
+    """
+    Maps lower-cased Slack display names (and usernames) to user IDs.
+
+    The map is built from all pages of users.list, and kept in an on-disk
+    cache for ttl seconds so restarts do not need the Slack API. A
+    background thread can refresh it; the new map then replaces the
+    global SLACK_USERMAP in one go.
+    """
+    def __init__(self, cache_filename=SLACK_USERMAP_CACHE,
+                 ttl=SLACK_USERMAP_TTL):
+        self.cache_filename = cache_filename
+        self.ttl = ttl
+
+    def users_list_page(self, cursor):
+        """
+        Return the status code and the JSON of one page of users.list.
+        """
+        import requests
+
+        ret = requests.get(
+            SLACK_API_USERS_LIST,
+            headers={'Authorization': f'Bearer {SLACK_API_BEARER}'},
+            params={'limit': 200, 'cursor': cursor}, timeout=10)
+        if ret.status_code == 429:
+            return 429, {'retry_after': ret.headers.get('Retry-After', 1)}
+        try:
+            return ret.status_code, ret.json()
+        except Exception as e:
+            return ret.status_code, {'error': f'{e}: {ret.text}'}
+
+    @staticmethod
+    def build_index(members):
+        usermap = {}
+        # The display name wins over the (older style) username.
+        for member in members:
+            name = member.get('name', '').lower()
+            if name:
+                usermap.setdefault(name, member['id'])
+        for member in members:
+            display_name = member['profile']['display_name'].lower()
+            if display_name:
+                usermap[display_name] = member['id']
+        return usermap
+
+    def fetch(self):
+        """
+        Return the usermap from users.list, or None on failure.
+        """
+        if not SLACK_API_BEARER:
+            print('no SLACK_API_BEARER token to get users.list')
+            return None
+
+        members = []
+        cursor = ''
+        attempts = 0
+        while True:
+            status_code, users_list = self.users_list_page(cursor)
+            if status_code == 429 and attempts < 5:
+                attempts += 1
+                time.sleep(float(users_list['retry_after']))
+                continue
+            if status_code != 200 or not users_list.get('ok', True):
+                print(f'failed to get users.list: {status_code} {users_list}')
+                return None
+            try:
+                members.extend(users_list['members'])
+                cursor = users_list.get(
+                    'response_metadata', {}).get('next_cursor', '')
+                if not cursor:
+                    return self.build_index(members)
+            except Exception as e:
+                print(f'failed to parse users.list: {e}: {users_list}')
+                return None
+
+    def load_cache(self, max_age=None):
+        try:
+            if max_age is not None and (
+                    time.time() - os.stat(self.cache_filename).st_mtime
+                    > max_age):
+                return None
+            with open(self.cache_filename) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def save_cache(self, usermap):
+        tmpname = f'{self.cache_filename}.tmp'
+        try:
+            with open(tmpname, 'w') as fp:
+                json.dump(usermap, fp)
+            os.replace(tmpname, self.cache_filename)
+        except OSError as e:
+            print(f'failed to save usermap cache: {e}')
+
+    def get(self):
+        """
+        Return the usermap from the cache if fresh, or from Slack. If that
+        fails, fall back to a stale cache.
+        """
+        usermap = self.load_cache(max_age=self.ttl)
+        if usermap is not None:
+            return usermap
+
+        usermap = self.fetch()
+        if usermap is not None:
+            self.save_cache(usermap)
+            return usermap
+
+        return self.load_cache() or {}
+
+    def refresh(self):
+        global SLACK_USERMAP
+        usermap = self.fetch()
+        if usermap is not None:
+            self.save_cache(usermap)
+            SLACK_USERMAP = usermap
+            MENTIONS.clear()
+            print(f'# refreshed SLACK_USERMAP ({len(usermap)} entries)')
+
+    def refresh_forever(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except Exception:
+                print_exc()
+
+    def start_refresh(self, interval=SLACK_USERMAP_REFRESH):
+        threading.Thread(
+            target=self.refresh_forever, args=(interval,),
+            name='usermap', daemon=True).start()
 
 
 def make_slack_message(message):
@@ -131,14 +593,338 @@ def make_slack_message(message):
     return json.dumps(request)
 
 
-def send_slack_message(message):
-    data = make_slack_message(message)
-    print(f'sending: {data}')
-    ret = requests.post(
-        SLACK_WEBHOOK_URL, data=data,
-        headers={'Content-Type': 'application/json'},
-        timeout=10)
-    assert ret.status_code == 200, (ret, ret.text)
+class RetryAfter(Exception):
+    """
+    Raised by Sink.deliver() when the receiver asks us to come back later.
+    """
+    def __init__(self, delay, reason):
+        super().__init__(f'{reason}, retry after {delay}')
+        self.delay = delay
+
+
+class Sink(ABC):
+    """
+    An output for the messages (and records) of an account.
+
+    Every sink has its own queue. Once start()ed, its own thread delivers
+    it, so a slow or failing sink holds up neither the other sinks nor
+    the polling. Until then, flush() does it. Messages only leave the
+    queue once deliver() succeeds; failures are retried with exponential
+    backoff, or after the delay of a RetryAfter. Delivery status is kept
+    per sink (sent, failures, last_error, last_latency) and exported as
+    metrics (with a sink label).
+
+    With urgent_only, only the records that are not NORMAL_EVENTS (the
+    <!channel> ones) are taken.
+    """
+    name = 'sink'
+    metric_prefix = 'log2slack_sink'
+    max_batch = 100
+
+    def __init__(self, account='', urgent_only=False):
+        self.account = account  # metrics label
+        self.urgent_only = urgent_only
+        self.queue = deque()  # (time queued, message, record)
+        self.sent = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_latency = None  # seconds from queueing to delivery
+        self.on_delivered = None  # called with the records, if set
+        self.gave_up = False  # the last flush() gave up, with messages left
+        self.running = False
+        self._cond = threading.Condition()
+
+    def __str__(self):
+        return self.name
+
+    def __len__(self):
+        return len(self.queue)
+
+    def labels(self):
+        return {'account': str(self.account), 'sink': self.name}
+
+    def accepts(self, record):
+        if self.urgent_only:
+            return (
+                record is not None and
+                record.event not in AlarmRecord.NORMAL_EVENTS)
+        return True
+
+    def put(self, message, record=None):
+        if not self.accepts(record):
+            return
+        with self._cond:
+            self.queue.append((time.time(), message, record))
+            METRICS.set(
+                f'{self.metric_prefix}_queue_depth', len(self.queue),
+                **self.labels())
+            self._cond.notify()
+
+    def next_batch(self):
+        with self._cond:
+            return list(self.queue)[:self.max_batch]
+
+    @abstractmethod
+    def deliver(self, batch):
+        """
+        Deliver a batch: a list of (time queued, message, record). Raises
+        on failure (RetryAfter to set the delay), so it is retried.
+        """
+
+    def flush(self, max_attempts=SLACK_MAX_ATTEMPTS):
+        """
+        Deliver the queue. Returns the records of the delivered messages.
+        Sets gave_up if it stopped after max_attempts failures.
+        """
+        delivered = []
+        attempt = 0
+        self.gave_up = False
+        while self.queue:
+            batch = self.next_batch()
+            try:
+                with METRICS.timer(
+                        f'{self.metric_prefix}_send_seconds', **self.labels()):
+                    self.deliver(batch)
+            except RetryAfter as e:
+                error, delay = e, e.delay
+            except Exception as e:
+                error, delay = e, min(2 ** attempt, 60)
+            else:
+                now = time.time()
+                with self._cond:
+                    for i in batch:
+                        self.queue.popleft()
+                    queued = len(self.queue)
+                records = [i[2] for i in batch if i[2] is not None]
+                self.sent += len(batch)
+                self.last_latency = now - batch[0][0]
+                METRICS.set(
+                    f'{self.metric_prefix}_queue_depth', queued,
+                    **self.labels())
+                METRICS.observe(
+                    f'{self.metric_prefix}_delivery_latency_seconds',
+                    self.last_latency, **self.labels())
+                METRICS.inc(
+                    f'{self.metric_prefix}_delivered_total', len(batch),
+                    **self.labels())
+                delivered.extend(records)
+                if self.on_delivered is not None and records:
+                    self.on_delivered(records)
+                attempt = 0
+                continue
+
+            attempt += 1
+            self.failures += 1
+            self.last_error = error
+            METRICS.inc(
+                f'{self.metric_prefix}_retries_total', **self.labels())
+            if attempt >= max_attempts:
+                print(f'{self}: giving up for now after {error}, '
+                      f'{len(self.queue)} messages queued')
+                self.gave_up = True
+                break
+            print(f'{self}: {error}, retrying after {delay}')
+            time.sleep(delay)
+
+        return delivered
+
+    def start(self):
+        self.running = True
+        threading.Thread(
+            target=self.run, name=f'sink-{self}-{self.account}',
+            daemon=True).start()
+        return self
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self.queue:
+                    self._cond.wait()
+            try:
+                self.flush()
+            except Exception:
+                print_exc()
+                self.gave_up = True
+            if self.gave_up:
+                # Try again later. Messages queued meanwhile (after flush()
+                # emptied the queue) do not wait for this.
+                time.sleep(SLEEP_AFTER_FAIL)
+
+    def status(self):
+        return (
+            f'{self}: {len(self)} queued, {self.sent} sent, '
+            f'{self.failures} failures (last: {self.last_error}), '
+            f'last latency {self.last_latency}')
+
+
+class SlackOutbox(Sink):
+    """
+    Slack webhook sink.
+
+    Coalesces the queued messages (one per line) into as few webhook
+    calls as the Slack message length allows. Rate limits (429) are
+    retried after the Retry-After the response asks for.
+    """
+    name = 'slack'
+    metric_prefix = 'log2slack_slack'
+
+    def __init__(self, webhook_url, max_length=SLACK_MAX_MESSAGE_LENGTH,
+                 account='', urgent_only=False):
+        super().__init__(account=account, urgent_only=urgent_only)
+        self.webhook_url = webhook_url
+        self.max_length = max_length
+        if urgent_only:
+            self.name = 'slack-channel'
+
+    def next_batch(self):
+        with self._cond:
+            queue = list(self.queue)
+        batch = [queue[0]]
+        length = len(batch[0][1])
+        for item in queue[1:]:
+            length += 1 + len(item[1])
+            if length > self.max_length:
+                break
+            batch.append(item)
+        return batch
+
+    def post(self, message):
+        import requests
+
+        data = make_slack_message(message)
+        print(f'sending: {data}')
+        return requests.post(
+            self.webhook_url, data=data,
+            headers={'Content-Type': 'application/json'},
+            timeout=10)
+
+    def deliver(self, batch):
+        ret = self.post('\n'.join(i[1] for i in batch))
+        if ret.status_code == 429:
+            raise RetryAfter(float(ret.headers.get('Retry-After', 1)), ret)
+        if ret.status_code != 200:
+            raise ValueError(f'{ret} {getattr(ret, "text", "")}')
+
+
+def record_to_json(record, **extra):
+    return dict(
+        extra, datetime=record.datetime.isoformat(), event=record.event,
+        group=record.group, sector=record.sector, extra=record.extra)
+
+
+class JsonLinesSink(Sink):
+    """
+    Appends a JSON object per message to a file, or to stdout for '-'.
+    """
+    name = 'jsonl'
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(**kwargs)
+        self.filename = filename
+
+    def deliver(self, batch):
+        lines = []
+        for queued, message, record in batch:
+            data = {'account': str(self.account), 'message': message}
+            if record is not None:
+                data['record'] = record_to_json(record)
+            lines.append(json.dumps(data) + '\n')
+        if self.filename == '-':
+            sys.stdout.write(''.join(lines))
+            sys.stdout.flush()
+        else:
+            with open(self.filename, 'a') as fp:
+                fp.write(''.join(lines))
+
+
+class WebhookSink(Sink):
+    """
+    POSTs the messages as JSON to a generic HTTP webhook:
+    {"account": ..., "messages": [{"message": ..., "record": {...}}]}
+    """
+    name = 'webhook'
+
+    def __init__(self, url, **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+
+    def deliver(self, batch):
+        import requests
+
+        messages = []
+        for queued, message, record in batch:
+            messages.append({'message': message})
+            if record is not None:
+                messages[-1]['record'] = record_to_json(record)
+        ret = requests.post(
+            self.url, timeout=10,
+            json={'account': str(self.account), 'messages': messages})
+        if ret.status_code == 429:
+            raise RetryAfter(float(ret.headers.get('Retry-After', 1)), ret)
+        if not 200 <= ret.status_code < 300:
+            raise ValueError(f'{ret} {ret.text[:200]}')
+
+
+class SyslogSink(Sink):
+    """
+    Sends the messages to syslog (RFC 3164, facility user): to a local
+    socket (/dev/log) or to HOST[:PORT] over UDP. Records that are not
+    NORMAL_EVENTS get severity warning, the rest info.
+    """
+    name = 'syslog'
+
+    def __init__(self, address, **kwargs):
+        super().__init__(**kwargs)
+        self.address = address
+        self.sock = None
+
+    def connect(self):
+        import socket
+
+        if self.address.startswith('/'):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.connect(self.address)
+        else:
+            host, sep, port = self.address.partition(':')
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.connect((host, int(port or 514)))
+        return sock
+
+    def deliver(self, batch):
+        if self.sock is None:
+            self.sock = self.connect()
+        try:
+            for queued, message, record in batch:
+                severity = 6  # info
+                if record is not None and (
+                        record.event not in AlarmRecord.NORMAL_EVENTS):
+                    severity = 4  # warning
+                self.sock.send(
+                    f'<{8 + severity}>log2slack[{self.account}]: {message}'
+                    .encode('utf-8'))
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            raise
+
+
+def make_sinks(account, slack_webhook_url, slack_channel_webhook_url='',
+               jsonl_file='', webhook_url='', syslog_address=''):
+    """
+    Return the sinks of an account. The (first) Slack sink is the one the
+    PublishedLedger follows.
+    """
+    sinks = [SlackOutbox(slack_webhook_url, account=account)]
+    if slack_channel_webhook_url:
+        sinks.append(SlackOutbox(
+            slack_channel_webhook_url, account=account, urgent_only=True))
+    if jsonl_file:
+        sinks.append(JsonLinesSink(jsonl_file, account=account))
+    if webhook_url:
+        sinks.append(WebhookSink(webhook_url, account=account))
+    if syslog_address:
+        sinks.append(SyslogSink(syslog_address, account=account))
+    return sinks
 
 
 def from_utf8(data):
@@ -152,6 +938,8 @@ def from_utf8(data):
 
 
 def decode_cookie(val):
+    import phpserialize
+
     decoding = []
 
     try:
@@ -191,41 +979,331 @@ def dump_cookies(session, where):
         print(f'cookies @ {where}: {key} ({type_}) = {decoded}')
 
 
-def login_and_fetch(klant_nummer, klant_gecrypt):
-    # Session keeps cookies around.
-    with requests.Session() as session:
-        ret = session.get(ALERTMOBILE_URL, timeout=10)
-        dump_cookies(session, 'first get')
-        assert ret.status_code == 200, (ret, ret.text)
-
-        ret = session.post(ALERTMOBILE_URL, data={
-                'klantnr': klant_nummer, 'klantcode': '',
-                'gecrypt': klant_gecrypt}, timeout=10)
-        dump_cookies(session, 'login post')
-        assert ret.status_code == 200, (ret, ret.text)
+class PortalError(Exception):
+    """
+    The portal did not give us the status page.
+    """
+
+
+class LoginError(PortalError):
+    """
+    The portal keeps sending us the login form.
+    """
+
+
+def check_portal_response(ret):
+    if ret.status_code != 200:
+        raise PortalError(f'HTTP {ret.status_code}: {ret.text[:200]!r}')
+
+
+def classify_failure(exc):
+    """
+    Return the kind of failure of a poll: 'network' (the portal is down
+    or unreachable), 'auth' (we cannot log in) or 'parse' (we got a page
+    we don't understand).
+    """
+    import requests
+
+    if isinstance(exc, LoginError):
+        return 'auth'
+    if isinstance(exc, (PortalError, requests.RequestException, OSError)):
+        return 'network'
+    return 'parse'
+
+
+def is_status_page(text):
+    """
+    Is text a status page, with the complete history table? Not just the
+    header: an empty table has no rows, a missing one means we got
+    another page.
+    """
+    marker = text.find('Recent ontvangen meldingen:')
+    if marker == -1:
+        return False
+    start = text.find('<table', marker)
+    return start != -1 and text.find('</table>', start) != -1
+
+
+class AlertMobileSession:
+    """
+    Long-lived portal session. Keeps the requests.Session (and with it
+    the pooled keep-alive connection and the oa-koi-kb login cookie)
+    around between poll cycles, so we only need a single GET of the
+    status page per cycle. We log in again only when the portal sends
+    us back to the login form.
+    """
+    def __init__(self, klant_nummer, klant_gecrypt):
+        self.klant_nummer = klant_nummer
+        self.klant_gecrypt = klant_gecrypt
+        self.session = None
+        self.logins = 0
+        self.last_bytes = None      # bytes transferred for the status page
+        self.last_first_row = None  # seconds until its first table row
+
+    @property
+    def status_url(self):
+        return f'{ALERTMOBILE_URL}?mscherm=status&div=historie'
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def new_session(self):
+        import requests
+
+        return requests.Session()
+
+    def login(self):
+        with METRICS.timer(
+                'log2slack_portal_login_seconds', account=self.klant_nummer):
+            self._login()
+
+    def _login(self):
+        self.close()
+        self.session = self.new_session()
+
+        ret = self.session.get(ALERTMOBILE_URL, timeout=10)
+        dump_cookies(self.session, 'first get')
+        check_portal_response(ret)
+
+        ret = self.session.post(ALERTMOBILE_URL, data={
+                'klantnr': self.klant_nummer, 'klantcode': '',
+                'gecrypt': self.klant_gecrypt}, timeout=10)
+        dump_cookies(self.session, 'login post')
+        check_portal_response(ret)
+        self.logins += 1
+
+    def fetch_status(self):
+        logged_in = False
+        if self.session is None:
+            self.login()
+            logged_in = True
 
         for attempt in range(10):
-            ret = session.get(
-                f'{ALERTMOBILE_URL}?mscherm=status&div=historie',
-                timeout=10)
-            dump_cookies(session, 'status get')
-            assert ret.status_code == 200, (ret, ret.text)
+            text = self.get_status()
+            if logged_in:
+                dump_cookies(self.session, 'status get')
 
-            if 'Recent ontvangen meldingen:' in ret.text:
+            if is_status_page(text):
                 break
-            elif 'koi_kb.php?mscherm=gebruiker_wijzigen' in ret.text:
+            elif 'koi_kb.php?mscherm=gebruiker_wijzigen' in text:
                 # Old data? Need to call the status screen at least one
                 # second time. Not sure if it's because we "have to go
                 # through another page" or if it's a timing thing.
                 time.sleep(0.3)
+            elif not logged_in:
+                # Session expired? We got the login form, or some other
+                # (error) page instead. Log in again, once.
+                print('# no status page, logging in again')
+                self.login()
+                logged_in = True
             else:
                 break
 
-        assert 'Recent ontvangen meldingen:', (ret, ret.text)
-    return ret.text
+        if not is_status_page(text):
+            # Don't keep a session around that does not get us data.
+            self.close()
+            if 'name="klantnr"' in text:
+                raise LoginError(f'login failed: {text[:200]!r}')
+            raise PortalError(f'no status page: {text[:200]!r}')
+        return text
+
+    def get_status(self):
+        """
+        GET the status page, compressed and streamed, stopping once the
+        history table is in (see read_status_page).
+        """
+        with METRICS.timer(
+                'log2slack_portal_fetch_seconds', account=self.klant_nummer):
+            started = time.perf_counter()
+            ret = self.session.get(
+                self.status_url, timeout=10, stream=True,
+                headers={'Accept-Encoding': 'gzip, deflate'})
+            try:
+                check_portal_response(ret)
+                text, received, first_row = read_status_page(ret, started)
+            finally:
+                ret.close()
+
+        self.last_bytes, self.last_first_row = received, first_row
+        METRICS.inc(
+            'log2slack_portal_bytes_total', received,
+            account=self.klant_nummer)
+        METRICS.set(
+            'log2slack_portal_page_bytes', received,
+            account=self.klant_nummer)
+        if first_row is not None:
+            METRICS.observe(
+                'log2slack_portal_first_row_seconds', first_row,
+                account=self.klant_nummer)
+        return text
+
+
+def read_status_page(ret, started):
+    """
+    Read a streamed status page response up to the closing </table> of
+    the history table, and at most PORTAL_DRAIN_MAX bytes beyond it.
+    Returns the text, the bytes transferred and the seconds from started
+    to the first table row (None if there was none).
+    """
+    decoder = getincrementaldecoder(ret.encoding or 'utf-8')(errors='replace')
+    chunks = ret.iter_content(PORTAL_READ_CHUNK)
+    text = ''
+    received = searched = 0
+    marker = table_end = -1
+    first_row = None
+
+    for chunk in chunks:
+        received += len(chunk)
+        text += decoder.decode(chunk)
+        if marker == -1:
+            marker = text.find(
+                'Recent ontvangen meldingen:', max(0, searched - 32))
+        if marker != -1:
+            if first_row is None and text.find(
+                    '<td', max(marker, searched - 3)) != -1:
+                first_row = time.perf_counter() - started
+            table_end = text.find('</table>', max(marker, searched - 8))
+            if table_end != -1:
+                break
+        searched = len(text)
+
+    if table_end != -1:
+        drained = 0
+        for chunk in chunks:
+            received += len(chunk)
+            drained += len(chunk)
+            text += decoder.decode(chunk)
+            if drained > PORTAL_DRAIN_MAX:
+                break
+    text += decoder.decode(b'', True)
+
+    # The bytes on the wire (compressed), if we can tell.
+    with suppress(AttributeError, TypeError):
+        received = int(ret.raw.tell())
+    return text, received, first_row
+
+
+_alertmobile_sessions = {}
+
+
+def login_and_fetch(klant_nummer, klant_gecrypt):
+    # Sessions are kept around (per klant_nummer) between calls.
+    try:
+        session = _alertmobile_sessions[klant_nummer]
+    except KeyError:
+        session = _alertmobile_sessions[klant_nummer] = AlertMobileSession(
+            klant_nummer, klant_gecrypt)
+    return session.fetch_status()
+
+
+def reset_sessions(klant_nummer=None):
+    for key in list(_alertmobile_sessions.keys()):
+        if klant_nummer is None or key == klant_nummer:
+            _alertmobile_sessions.pop(key).close()
+
+
+class HtmlTableParser(HTMLParser):
+    """
+    Event-driven extractor of the rows of the first <table> in a page.
+
+    Completed rows are put on self.rows as dicts (keyed by the <th>
+    texts of the <thead>). Everything after the closing </table> is
+    ignored: self.done is set and the caller can stop feeding us.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.columns = []
+        self.rows = deque()
+        self.done = False
+        self._in_table = False
+        self._in_thead = self._in_tbody = False
+        self._header_done = False
+        self._cells = None  # list of cell texts of the current row
+        self._text = None   # list of text parts of the current cell
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if not self._in_table:
+            self._in_table = (tag == 'table')
+        elif tag == 'thead':
+            self._in_thead = True
+        elif tag == 'tbody':
+            self._in_tbody = True
+        elif tag == 'tr':
+            if ((self._in_thead and not self._header_done) or
+                    self._in_tbody):
+                self._cells = []
+        elif tag in ('th', 'td') and self._cells is not None:
+            self._text = []
+
+    def handle_data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+    def handle_endtag(self, tag):
+        if not self._in_table or self.done:
+            return
+        if tag == 'table':
+            self.done = True
+        elif tag == 'thead':
+            self._in_thead = False
+        elif tag == 'tbody':
+            self._in_tbody = False
+        elif tag in ('th', 'td') and self._text is not None:
+            text = ''.join(self._text)
+            self._cells.append(text if tag == 'th' else text.strip())
+            self._text = None
+        elif tag == 'tr' and self._cells is not None:
+            if self._in_tbody:
+                if len(self._cells) > len(self.columns):
+                    raise IndexError(str(self._cells))
+                self.rows.append(dict(zip(self.columns, self._cells)))
+            elif not self._header_done:
+                self.columns = self._cells
+                self._header_done = True
+            self._cells = None
+
+
+def iter_html_table_rows(html_chunks, chunk_size=8192):
+    """
+    Yield the rows of the first <table> as dicts, while parsing.
+
+    Takes either the full HTML document or an iterable of text chunks.
+    Stops reading as soon as the table is complete.
+    """
+    if isinstance(html_chunks, str):
+        html_doc = html_chunks
+        html_chunks = (
+            html_doc[i:(i + chunk_size)]
+            for i in range(0, len(html_doc), chunk_size))
+
+    parser = HtmlTableParser()
+    for chunk in html_chunks:
+        parser.feed(chunk)
+        while parser.rows:
+            yield parser.rows.popleft()
+        if parser.done:
+            break
+    else:
+        parser.close()
+        while parser.rows:
+            yield parser.rows.popleft()
 
 
 def html_table_to_dicts(html_doc):
+    return list(iter_html_table_rows(html_doc))
+
+
+def html_table_to_dicts_bs4(html_doc):
+    """
+    The original (full DOM) implementation of html_table_to_dicts. Kept
+    around as reference for the tests and benchmarks.
+    """
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(html_doc, 'html.parser')
 
     table = soup.find_all('table')[0]
@@ -260,168 +1338,1478 @@ def fix_dicts_datetime(data):
       'Sector': '0',
       'Tijd': '10:11:40'}]
     """
-    new_data = []
+    return list(iter_fix_dicts_datetime(data))
+
+
+def iter_fix_dicts_datetime(data):
     date = None
     for row in data:
-        # The "Aansluiting" field is not shown in the verbose/long
-        # status, but it's shown in the short one.
-        if (row.get('Aansluiting', '') == row['Alrm'] == row['Groep']
-                == row['Omschrijving'] == '' and row['Sector'] == '---'):
-            dd, mm, yy = row['Tijd'].split('/')
-            date = datetime.date(2000 + int(yy), int(mm), int(dd))
+        if is_date_row(row):
+            date = row_date(row)
         else:
-            hh, mm, ss = row['Tijd'].split(':')
-            # datetimes are TZ agnostic (= localtime)
-            row['Tijd'] = datetime.datetime(
-                date.year, date.month, date.day, int(hh), int(mm), int(ss))
-            new_data.append(row)
-    return new_data
+            row['Tijd'] = row_datetime(row, date)
+            yield row
+
+
+def is_date_row(row):
+    # The "Aansluiting" field is not shown in the verbose/long
+    # status, but it's shown in the short one.
+    return (row.get('Aansluiting', '') == row['Alrm'] == row['Groep']
+            == row['Omschrijving'] == '' and row['Sector'] == '---')
+
+
+def row_date(row):
+    dd, mm, yy = row['Tijd'].split('/')
+    return datetime.date(2000 + int(yy), int(mm), int(dd))
+
+
+def row_datetime(row, date):
+    hh, mm, ss = row['Tijd'].split(':')
+    # datetimes are TZ agnostic (= localtime)
+    return datetime.datetime(
+        date.year, date.month, date.day, int(hh), int(mm), int(ss))
+
+
+def take_rows_since(data, since):
+    """
+    Pass through the (newest first) raw table rows until we get to rows
+    older than since. Rows with the since timestamp itself are passed,
+    as there may be more events in that same second.
+
+    This lets the caller stop reading/parsing the table once it gets to
+    the part it has already seen.
+    """
+    date = None
+    for row in data:
+        if is_date_row(row):
+            date = row_date(row)
+        elif row_datetime(row, date) < since:
+            break
+        yield row
+
+
+def fix_dicts_who_did_what(data):
+    """
+    The dict has info in a higher up event. Or sometimes lower..
+
+    [{'Aansluiting': 'E0123456',
+      'Alrm': 'INF',
+      'Groep': '6',
+      'Omschrijving': 'UITGESCH. JOHN',
+      'Sector': '0',
+      'Tijd': datetime.datetime(2001, 11, 22, 8, 45, 27)},
+     {'Aansluiting': 'E0123456',
+      'Alrm': 'UIT',
+      'Groep': '6',
+      'Omschrijving': 'Uit',
+      'Sector': '0',
+      'Tijd': datetime.datetime(2001, 11, 22, 8, 45, 27)}]
+    """
+    return list(iter_fix_dicts_who_did_what(data))
+
+
+def iter_fix_dicts_who_did_what(data):
+    info = None
+    # The last row is held back for one row, because the INF row
+    # belonging to it may come after it.
+    last_row = None
+    for row in data:
+        if row['Alrm'] == 'INF':
+            if last_row is not None and (
+                    last_row.get('Aansluiting') == row.get('Aansluiting') and
+                    last_row['Groep'] == row['Groep'] and
+                    last_row['Sector'] == row['Sector'] and
+                    last_row['Tijd'] == row['Tijd']):
+                last_row['Info'] = row['Omschrijving']
+            else:
+                info = row
+        elif info is not None:
+            assert row.get('Aansluiting') == info.get('Aansluiting'), (row, info)
+            assert row['Groep'] == info['Groep'], (row, info)
+            assert row['Sector'] == info['Sector'], (row, info)
+            assert row['Tijd'] == info['Tijd'], (row, info)
+            row['Info'] = info['Omschrijving']
+            info = None
+            if last_row is not None:
+                yield last_row
+            yield row
+            last_row = None
+        else:
+            if last_row is not None:
+                yield last_row
+            last_row = row
+
+    if last_row is not None:
+        yield last_row
+
+
+def to_records(data):
+    return list(iter_records(data))
+
+
+def iter_records(data):
+    first = None
+    for row in data:
+        if first is None:
+            first = row
+        assert row.get('Aansluiting') == first.get('Aansluiting'), (
+            row, first)
+        event = {
+                'IN': 'ALARM_ON',
+                'UIT': 'ALARM_OFF',
+                '24H': '24H',                       # ?, always "AUTOTEST"
+                # The following concern the known times in which the
+                # alarm may be switched on/off.
+                'TVU': 'UNEXPECT_ALARM_OFF',        # "Te Vroeg Uitgeschakeld"
+                'TLI': 'UNEXPECT_NO_ALARM_YET',     # "Te Laat Ingeschakeld"
+                'AFW': 'OVERRIDE_ALARM_TIME',       # Afwijkende tijd(?)
+            }.get(
+            row['Alrm'], row['Alrm'])
+
+        extra = row['Info'] if 'Info' in row else ''
+        if row['Omschrijving']:
+            if extra and extra != ':':
+                extra += f' ({row["Omschrijving"]})'
+            else:
+                extra = row['Omschrijving']
+
+        yield AlarmRecord(
+            datetime=row['Tijd'], event=(event or '(log)'), group=row['Groep'],
+            sector=row['Sector'], extra=extra)
+
+
+def iter_coalesce_records(data):
+    """
+    Merge the (log) records into the X-M/Y-M (begin/end of a maintenance
+    test) record they belong to: same datetime and sector, next to each
+    other. The portal lists them like this:
+
+        13:54:51 (log) Gebr.: Mark Evert Chaniciën
+        13:54:51 (log) Resultaat : Test volgens plan verlopen
+        13:54:51 Y-M   Einde test Monteur
+
+    which becomes a single record:
+
+        13:54:51 Y-M   Einde test Monteur (Gebr.: Mark Evert Chaniciën;
+                       Resultaat : Test volgens plan verlopen)
+
+    Anything else is passed through untouched, in the same order.
+    """
+    def merged(batch):
+        main = [i for i in batch if i.event != '(log)']
+        if len(batch) < 2 or len(main) != 1 or (
+                main[0].event not in ('X-M', 'Y-M')):
+            return batch
+        main = main[0]
+        logs = '; '.join(i.extra for i in batch if i is not main)
+        return [AlarmRecord(
+            datetime=main.datetime, event=main.event, group=main.group,
+            sector=main.sector, extra=f'{main.extra} ({logs})')]
+
+    batch = []
+    for record in data:
+        if batch and (
+                record.timestamp != batch[0].timestamp or
+                record.sector != batch[0].sector or
+                record.event not in ('(log)', 'X-M', 'Y-M')):
+            yield from merged(batch)
+            batch = []
+        if record.event in ('(log)', 'X-M', 'Y-M'):
+            batch.append(record)
+        else:
+            yield record
+    yield from merged(batch)
+
+
+def make_klant_gecrypt(klant_code):
+    return md5(klant_code.encode('ascii')).hexdigest()
+
+
+def fetch(klant_nummer, klant_gecrypt, cache_filename=CACHE_FILENAME):
+    try:
+        with open(cache_filename) as fp:
+            data = fp.read()
+    except Exception:
+        # Leave exception handler so we won't see this as cause later on.
+        data = ''
+
+    if 'Recent ontvangen meldingen:' not in data:
+        data = login_and_fetch(klant_nummer, klant_gecrypt)
+        with open(cache_filename, 'w') as fp:
+            fp.write(data)
+
+    return data
+
+
+def table_region(html_doc):
+    """
+    Return the history table part of the status page, or the entire page
+    if we cannot find it.
+    """
+    start = html_doc.find('Recent ontvangen meldingen:')
+    if start == -1:
+        return html_doc
+    end = html_doc.find('</table>', start)
+    if end == -1:
+        return html_doc[start:]
+    return html_doc[start:(end + 8)]
+
+
+def table_fingerprint(html_doc):
+    return sha256(table_region(html_doc).encode('utf-8')).hexdigest()
+
+
+class SnapshotStore:
+    """
+    Archive of every distinct status page, as a replay corpus for when
+    parsing goes wrong.
+
+    Pages are stored gzipped as <dir>/<sha256 of the table>.html.gz, so
+    a page is only written when the history table changed. The oldest
+    snapshots are removed when they are older than max_age or when the
+    total exceeds max_bytes.
+    """
+    def __init__(self, directory, max_age=SNAPSHOT_MAX_AGE,
+                 max_bytes=SNAPSHOT_MAX_BYTES):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.last_fingerprint = None
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, html_doc, fingerprint=None):
+        """
+        Store html_doc, unless we already have it. Returns the filename
+        if it was written.
+        """
+        if fingerprint is None:
+            fingerprint = table_fingerprint(html_doc)
+        if fingerprint == self.last_fingerprint:
+            return None
+        self.last_fingerprint = fingerprint
+
+        filename = os.path.join(self.directory, f'{fingerprint}.html.gz')
+        if os.path.exists(filename):
+            return None
+
+        tmpname = f'{filename}.tmp'
+        with gzip.open(tmpname, 'wt', encoding='utf-8') as fp:
+            fp.write(html_doc)
+        os.replace(tmpname, filename)
+        self.prune()
+        return filename
+
+    def snapshots(self):
+        """
+        Return (mtime, size, filename) of the snapshots, oldest first.
+        """
+        snapshots = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.html.gz'):
+                    st = entry.stat()
+                    snapshots.append((st.st_mtime, st.st_size, entry.path))
+        snapshots.sort()
+        return snapshots
+
+    def prune(self):
+        snapshots = self.snapshots()
+        total = sum(i[1] for i in snapshots)
+        too_old = time.time() - self.max_age
+        for mtime, size, filename in snapshots[:-1]:  # keep the newest
+            if mtime >= too_old and total <= self.max_bytes:
+                break
+            with suppress(FileNotFoundError):
+                os.unlink(filename)
+            total -= size
+
+
+def parse_logs(html_doc, since=None):
+    """
+    Yield the AlarmRecords from the status page, newest first. All
+    stages are generators, so a row flows through the entire pipeline
+    before the next one is read.
+
+    If since (a datetime) is set, only the records from that time on are
+    parsed.
+    """
+    data = iter_html_table_rows(html_doc)
+    if since is not None:
+        data = take_rows_since(data, since)
+    data = iter_fix_dicts_datetime(data)
+    data = iter_fix_dicts_who_did_what(data)
+    data = iter_records(data)
+    return iter_coalesce_records(data)
+
+
+def fetch_logs(since=None):
+    data = fetch(KLANT_NUMMER, make_klant_gecrypt(KLANT_CODE))
+    data = list(parse_logs(data, since))
+    # data = [i for i in data if i.event in ('ALARM_ON', 'ALARM_OFF')]
+    # os.unlink(CACHE_FILENAME)
+    return data
+
+
+def read_snapshot(filename):
+    if filename.endswith('.gz'):
+        with gzip.open(filename, 'rt', encoding='utf-8') as fp:
+            return fp.read()
+    with open(filename) as fp:
+        return fp.read()
+
+
+def replay_snapshot(filename):
+    """
+    Parse a single snapshot. Returns (filename, records, error). Runs in
+    the replay worker processes.
+    """
+    try:
+        records = list(parse_logs(read_snapshot(filename)))
+    except Exception as e:
+        return filename, [], f'{e.__class__.__name__}: {e}'
+    return filename, records, None
+
+
+def find_snapshots(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                # In the order they were saved: the names are hashes.
+                snapshots = sorted(
+                    (os.path.getmtime(os.path.join(dirpath, i)), i)
+                    for i in filenames if i.endswith(('.html', '.html.gz')))
+                for mtime, filename in snapshots:
+                    yield os.path.join(dirpath, filename)
+        else:
+            yield path
+
+
+def replay_cycles(paths, max_workers=None):
+    """
+    Parse all snapshots in paths (files or directories) in parallel.
+    Yields, per snapshot, the AlarmRecords not seen in the ones before
+    it, oldest first: what the poll that fetched it published.
+    """
+    # Records are repeated in many snapshots (consecutive ones are nearly
+    # identical), so deduplicate as they come in: we keep the distinct
+    # records only, not the rows of every snapshot.
+    seen = set()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for filename, records, error in executor.map(
+                replay_snapshot, find_snapshots(paths), chunksize=8):
+            if error is not None:
+                print(f'replay: {filename}: {error}', file=sys.stderr)
+            new = set(records) - seen
+            seen.update(new)
+            yield sorted(new, key=AlarmRecord.SORT_KEY)
+
+
+class ReplayOutbox(SlackOutbox):
+    """
+    SlackOutbox that collects the messages instead of posting them.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(webhook_url=None, account='replay', **kwargs)
+        self.posted = []
+
+    def deliver(self, batch):
+        self.posted.append('\n'.join(i[1] for i in batch))
+
+
+def replay(paths, max_workers=None):
+    """
+    Yield the Slack messages the publisher would have posted for the
+    snapshots in paths: the new records of every snapshot, coalesced
+    into webhook messages by the SlackOutbox.
+    """
+    outbox = ReplayOutbox()
+    for records in replay_cycles(paths, max_workers=max_workers):
+        for record in records:
+            outbox.put(str(record), record)
+        outbox.flush()
+        yield from outbox.posted
+        outbox.posted.clear()
+
+
+class PublishedLedger:
+    """
+    Append-only on-disk log of published records, so a restart does not
+    re-post everything from the last PUBLISH_LOOKBACK to Slack.
+
+    Each line is a JSON list [datetime, event, group, sector, extra].
+    Appends are flushed right away, but fsync'ed only once per cycle in
+    commit(). Records older than the lookback window are dropped, and
+    the file is rewritten when it holds too many of those.
+
+    Records are looked up by key(): X-M/Y-M records without their extra,
+    as that changed when we started merging their (log) records into it
+    (iter_coalesce_records). So the records in ledgers written before
+    that still match, and are not posted again.
+    """
+    def __init__(self, filename, window=PUBLISH_LOOKBACK):
+        self.filename = filename
+        self.window = window
+        self.records = {}  # key() -> record
+        self._lines = 0
+        self._fp = None
+        self.load()
+
+    def __contains__(self, record):
+        return self.key(record) in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    @staticmethod
+    def key(record):
+        if record.event in ('X-M', 'Y-M'):
+            return (record.timestamp, record.event, record.group,
+                    record.sector)
+        return record
+
+    @staticmethod
+    def record_to_line(record):
+        return json.dumps([
+            record.datetime.isoformat(), record.event, record.group,
+            record.sector, record.extra]) + '\n'
+
+    @staticmethod
+    def line_to_record(line):
+        dt, event, group, sector, extra = json.loads(line)
+        return AlarmRecord(
+            datetime=datetime.datetime.fromisoformat(dt), event=event,
+            group=group, sector=sector, extra=extra)
+
+    def load(self):
+        a_while_ago = AlarmRecord.to_timestamp(
+            datetime.datetime.now() - self.window)
+        try:
+            with open(self.filename) as fp:
+                for line in fp:
+                    self._lines += 1
+                    try:
+                        record = self.line_to_record(line)
+                    except ValueError:
+                        # Torn write at the end? Dropped on compaction.
+                        print(f'ledger: skipping bad line {line!r}')
+                        continue
+                    if record.timestamp >= a_while_ago:
+                        self.records[self.key(record)] = record
+        except FileNotFoundError:
+            pass
+        self.compact()
+
+    def add(self, record):
+        if self._fp is None:
+            self._fp = open(self.filename, 'a')
+        self._fp.write(self.record_to_line(record))
+        self._fp.flush()
+        self._lines += 1
+        self.records[self.key(record)] = record
+
+    def commit(self):
+        if self._fp is not None:
+            os.fsync(self._fp.fileno())
+
+        a_while_ago = AlarmRecord.to_timestamp(
+            datetime.datetime.now() - self.window)
+        self.records = dict(
+            (key, record) for key, record in self.records.items()
+            if record.timestamp >= a_while_ago)
+        if self._lines > 2 * len(self.records) + 100:
+            self.compact()
+
+    def compact(self):
+        if self._lines == len(self.records):
+            return
+        self.close()
+        tmpname = f'{self.filename}.tmp'
+        with open(tmpname, 'w') as fp:
+            for record in sorted(
+                    self.records.values(), key=AlarmRecord.SORT_KEY):
+                fp.write(self.record_to_line(record))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmpname, self.filename)
+        self._lines = len(self.records)
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+class HistoryStore:
+    """
+    SQLite archive of every record seen, per account, so we keep them
+    after they scroll off the portal's table. Records are immutable:
+    seeing one again is a no-op. Every add() is a single transaction.
+
+    One store (and connection) is shared by all accounts that use the
+    same file, see open_history_store(). With read_only (for queries),
+    the file must exist and is not changed.
+    """
+    SCHEMA = '''\
+        CREATE TABLE IF NOT EXISTS record (
+            account TEXT NOT NULL,
+            datetime TEXT NOT NULL,  -- YYYY-MM-DD HH:MM:SS, localtime
+            event TEXT NOT NULL,
+            "group" TEXT NOT NULL,
+            sector TEXT NOT NULL,
+            extra TEXT NOT NULL,
+            first_seen REAL NOT NULL,
+            UNIQUE (account, datetime, event, "group", sector, extra));
+        CREATE INDEX IF NOT EXISTS record_datetime ON record (datetime);
+        CREATE INDEX IF NOT EXISTS record_event
+            ON record (event, datetime);
+        CREATE INDEX IF NOT EXISTS record_group
+            ON record ("group", datetime);
+        CREATE INDEX IF NOT EXISTS record_account
+            ON record (account, datetime);
+    '''
+
+    def __init__(self, filename, read_only=False):
+        import sqlite3
+        from urllib.parse import quote
+
+        self.filename = filename
+        self._lock = threading.Lock()
+        if read_only:
+            # Raises sqlite3.OperationalError if there is no such file.
+            self.db = sqlite3.connect(
+                f'file:{quote(filename)}?mode=ro', uri=True,
+                check_same_thread=False)
+            return
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self._lock, self.db:
+            # WAL: the history command can read while we write.
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.executescript(self.SCHEMA)
+
+    def add(self, account, records):
+        """
+        Store the records of a poll cycle. Returns how many were new.
+        """
+        now = time.time()
+        rows = [
+            (str(account), str(i.datetime), i.event, i.group, i.sector,
+             i.extra, now) for i in records]
+        with self._lock, self.db:
+            before = self.db.total_changes
+            self.db.executemany(
+                '''INSERT OR IGNORE INTO record (account, datetime, event,
+                "group", sector, extra, first_seen)
+                VALUES (?, ?, ?, ?, ?, ?, ?)''', rows)
+            return self.db.total_changes - before
+
+    def query(self, account=None, event=None, group=None, since=None,
+              until=None, abnormal=False):
+        """
+        Return (account, record) tuples, oldest first. since/until are
+        datetimes, [since, until). With abnormal, only the records that
+        are not AlarmRecord.NORMAL_EVENTS.
+        """
+        where, args = [], []
+        for column, value in (
+                ('account', account), ('event', event), ('"group"', group)):
+            if value is not None:
+                where.append(f'{column} = ?')
+                args.append(value)
+        if since is not None:
+            where.append('datetime >= ?')
+            args.append(str(since))
+        if until is not None:
+            where.append('datetime < ?')
+            args.append(str(until))
+        if abnormal:
+            where.append('event NOT IN (%s)' % ', '.join(
+                '?' * len(AlarmRecord.NORMAL_EVENTS)))
+            args.extend(AlarmRecord.NORMAL_EVENTS)
+
+        sql = (
+            'SELECT account, datetime, event, "group", sector, extra '
+            'FROM record')
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY datetime, event'
+        with self._lock:
+            rows = self.db.execute(sql, args).fetchall()
+        return [
+            (account_, AlarmRecord(
+                datetime=datetime.datetime.fromisoformat(dt), event=event_,
+                group=group_, sector=sector, extra=extra))
+            for account_, dt, event_, group_, sector, extra in rows]
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+def format_duration(seconds):
+    minutes = int(seconds) // 60
+    if minutes >= 1440:
+        return f'{minutes // 1440}d {minutes % 1440 // 60}h'
+    if minutes >= 60:
+        return f'{minutes // 60}h {minutes % 60}m'
+    return f'{minutes}m'
+
+
+class ArmingAnalytics:
+    """
+    Incremental arm/disarm statistics of an account, posted as a digest
+    to Slack every DIGEST_PERIOD (daily or weekly).
+
+    We keep the current state of every group (armed or not, and since
+    when) and the totals of the current period: armed/disarmed time,
+    ALARM_ON/ALARM_OFF counts per group and per user, the too early
+    disarms (TVU) and too late armings (TLI), and the average arming
+    time. update() only looks at the new records, so the work per cycle
+    does not grow with the years of history. The state is saved as JSON.
+    """
+    PERIODS = {'daily': 1, 'weekly': 7}
+
+    def __init__(self, filename, period=DIGEST_PERIOD):
+        self.filename = filename
+        self.days = self.PERIODS.get(period)  # None: no digests
+        self.period = period
+        try:
+            with open(filename) as fp:
+                self.state = json.load(fp)
+        except FileNotFoundError:
+            self.state = self.new_state(self.timestamp())
+        except ValueError as e:
+            # Should not happen (see save()), but losing the stats beats
+            # not starting at all.
+            print(f'analytics: bad state in {filename} ({e}), starting over')
+            self.state = self.new_state(self.timestamp())
+
+    @staticmethod
+    def timestamp(dt=None):
+        return ((dt or datetime.datetime.now()) - _EPOCH) // _SECOND
+
+    def period_start(self, timestamp):
+        start = _EPOCH + datetime.timedelta(seconds=timestamp)
+        start = datetime.datetime.combine(start.date(), datetime.time())
+        if self.days == 7:
+            start -= datetime.timedelta(days=start.weekday())  # monday
+        return self.timestamp(start)
+
+    def period_end(self):
+        if self.days is None:
+            return float('inf')
+        end = (
+            _EPOCH + datetime.timedelta(seconds=self.state['period_start']) +
+            datetime.timedelta(days=self.days))
+        return self.timestamp(end)
+
+    def new_state(self, timestamp):
+        return {
+            'period_start': self.period_start(timestamp),
+            'last': [0, []],      # timestamp and keys of the newest records
+            'groups': {},         # group -> [armed, since]
+            'totals': {},         # group -> counters
+            'users': {},          # user -> [arms, disarms]
+            'arm_minutes': [0, 0],  # sum (from noon) and count
+            'previous': None,     # average arming minutes of last period
+        }
+
+    def update(self, records, now=None):
+        """
+        Add the new records (already seen ones are skipped). Returns the
+        digest messages that are due.
+        """
+        last_timestamp, last_keys = self.state['last']
+        digests = []
+        changed = False
+        for record in sorted(records, key=AlarmRecord.SORT_KEY):
+            if record.timestamp < last_timestamp:
+                continue
+            key = '|'.join(record._key()[1:])
+            if record.timestamp == last_timestamp:
+                if key in last_keys:
+                    continue
+            else:
+                last_timestamp, last_keys = record.timestamp, []
+            last_keys.append(key)
+            self.state['last'] = [last_timestamp, last_keys]
+
+            # The table is in order: once we see a record of the next
+            # period, the current one is complete.
+            if record.timestamp >= self.period_end():
+                digests.append(self.rollover(record.timestamp))
+            self.add(record)
+            changed = True
+
+        timestamp = self.timestamp(now)
+        if timestamp >= self.period_end() + DIGEST_GRACE:
+            digests.append(self.rollover(timestamp))
+        if changed or digests:
+            self.save()
+        return digests
+
+    def add(self, record):
+        state = self.state
+        timestamp = record.timestamp
+        in_period = (timestamp >= state['period_start'])
+
+        if record.event in ('ALARM_ON', 'ALARM_OFF'):
+            armed = (record.event == 'ALARM_ON')
+            self.close_interval(record.group, timestamp)
+            state['groups'][record.group] = [armed, timestamp]
+            if in_period:
+                self.totals(record.group)['on' if armed else 'off'] += 1
+                username = record.username
+                if username is not None:
+                    state['users'].setdefault(username, [0, 0])[
+                        0 if armed else 1] += 1
+                if armed:
+                    # Counted from noon, so arming just after midnight
+                    # averages as late, not as early.
+                    minutes = (timestamp // 60 - 720) % 1440
+                    state['arm_minutes'][0] += minutes
+                    state['arm_minutes'][1] += 1
+        elif in_period and record.event == 'UNEXPECT_ALARM_OFF':
+            self.totals(record.group)['early_off'] += 1
+        elif in_period and record.event == 'UNEXPECT_NO_ALARM_YET':
+            self.totals(record.group)['late_on'] += 1
+
+    def totals(self, group):
+        return self.state['totals'].setdefault(group, {
+            'armed': 0, 'disarmed': 0, 'on': 0, 'off': 0,
+            'early_off': 0, 'late_on': 0})
+
+    def close_interval(self, group, until):
+        try:
+            armed, since = self.state['groups'][group]
+        except KeyError:
+            return
+        seconds = until - max(since, self.state['period_start'])
+        if seconds > 0:
+            self.totals(group)['armed' if armed else 'disarmed'] += seconds
+
+    def rollover(self, timestamp):
+        """
+        Close the current period and start the one of timestamp. Returns
+        the digest of the closed period.
+        """
+        state = self.state
+        end = self.period_end()
+        for group in state['groups']:
+            self.close_interval(group, end)
+        message = self.digest(end)
+
+        arm_sum, arm_count = state['arm_minutes']
+        previous = (arm_sum / arm_count) if arm_count else None
+        new_state = self.new_state(timestamp)
+        new_state.update(
+            last=state['last'], groups=state['groups'], previous=previous)
+        self.state = new_state
+        return message
+
+    def digest(self, end):
+        state = self.state
+        start = _EPOCH + datetime.timedelta(seconds=state['period_start'])
+        end = _EPOCH + datetime.timedelta(seconds=end)
+        lines = [
+            f':bar_chart: {self.period} alarm digest, '
+            f'{start:%Y-%m-%d %H:%M} - {end:%Y-%m-%d %H:%M}']
+
+        period = (end - start).total_seconds()
+        for group, totals in sorted(state['totals'].items()):
+            line = (
+                f'G{group or "-"}: armed '
+                f'{100 * totals["armed"] / period:.0f}% '
+                f'({format_duration(totals["armed"])}), '
+                f'{totals["on"]}x on, {totals["off"]}x off')
+            if totals['early_off']:
+                line += f', {totals["early_off"]}x too early off'
+            if totals['late_on']:
+                line += f', {totals["late_on"]}x too late on'
+            lines.append(line)
+
+        if state['users']:
+            lines.append('users: ' + ', '.join(
+                f'{user} {arms}x on/{disarms}x off'
+                for user, (arms, disarms) in sorted(state['users'].items())))
+
+        arm_sum, arm_count = state['arm_minutes']
+        if arm_count:
+            average = arm_sum / arm_count
+            line = 'armed on average at {:02d}:{:02d}'.format(
+                *divmod(int(average + 720) % 1440, 60))
+            if state['previous'] is not None:
+                shift = average - state['previous']
+                line += (
+                    f' ({format_duration(abs(shift) * 60)} '
+                    f'{"later" if shift >= 0 else "earlier"} than before)')
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def save(self):
+        # Atomically: a crash leaves either the old or the new state.
+        tmpname = f'{self.filename}.tmp'
+        with open(tmpname, 'w') as fp:
+            json.dump(self.state, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmpname, self.filename)
+
+
+_history_stores = {}
+_history_stores_lock = threading.Lock()
+
+
+def open_history_store(filename):
+    with _history_stores_lock:
+        try:
+            return _history_stores[filename]
+        except KeyError:
+            store = _history_stores[filename] = HistoryStore(filename)
+            return store
+
+
+class Account:
+    """
+    A portal account that we poll and publish for. Every account has its
+    own portal session, cache file, dedup state and sinks (the Slack
+    webhook and the optional extra outputs).
+    """
+    def __init__(self, klant_nummer, klant_code, slack_webhook_url,
+                 cache_filename=None, ledger_file='', snapshot_dir='',
+                 history_db='', analytics_file='', sinks=None):
+        self.klant_nummer = klant_nummer
+        self.klant_gecrypt = make_klant_gecrypt(klant_code)
+        self.cache_filename = cache_filename or (
+            f'{CACHE_FILENAME.rsplit(".cache", 1)[0]}.{klant_nummer}.cache')
+        self.sinks = sinks or make_sinks(klant_nummer, slack_webhook_url)
+        # The ledger follows the (main) Slack outbox, which also gets the
+        # status notices.
+        self.outbox = next((
+            i for i in self.sinks
+            if isinstance(i, SlackOutbox) and not i.urgent_only),
+            self.sinks[0])
+        self.outbox.on_delivered = self.delivered
+        self._ledger_lock = threading.Lock()
+        self.ledger = PublishedLedger(ledger_file) if ledger_file else None
+        self.snapshots = SnapshotStore(snapshot_dir) if snapshot_dir else None
+        self.history = open_history_store(history_db) if history_db else None
+        self.analytics = (
+            ArmingAnalytics(analytics_file) if analytics_file else None)
+        self.already_published = set()
+        # Newest record seen. Once we have it, we only parse the part of
+        # the (newest first) table from its timestamp on.
+        self.high_water = None
+        # Fingerprint of the last parsed history table. Most polls get
+        # the same table, which we then don't need to parse at all.
+        self.last_fingerprint = None
+        self.unchanged_polls = 0
+        self.schedule = PollSchedule(
+            self, state_file=f'{self.cache_filename}.circuit')
+
+    def __str__(self):
+        return self.klant_nummer
+
+    @classmethod
+    def from_environ(cls):
+        return cls(
+            klant_nummer=KLANT_NUMMER, klant_code=KLANT_CODE,
+            slack_webhook_url=SLACK_WEBHOOK_URL,
+            cache_filename=CACHE_FILENAME, ledger_file=LEDGER_FILE,
+            snapshot_dir=SNAPSHOT_DIR, history_db=HISTORY_DB,
+            analytics_file=ANALYTICS_FILE, sinks=make_sinks(
+                KLANT_NUMMER, SLACK_WEBHOOK_URL, SLACK_CHANNEL_WEBHOOK_URL,
+                JSONL_FILE, WEBHOOK_URL, SYSLOG_ADDRESS))
+
+    @classmethod
+    def from_config(cls, config):
+        klant_nummer = config['klant_nummer']
+        slack_webhook_url = config.get('slack_webhook_url', SLACK_WEBHOOK_URL)
+        return cls(
+            klant_nummer=klant_nummer,
+            klant_code=config['klant_code'],
+            slack_webhook_url=slack_webhook_url,
+            cache_filename=config.get('cache_filename'),
+            ledger_file=config.get('ledger_file', ''),
+            snapshot_dir=config.get('snapshot_dir', (
+                os.path.join(SNAPSHOT_DIR, config['klant_nummer'])
+                if SNAPSHOT_DIR else '')),
+            history_db=config.get('history_db', HISTORY_DB),
+            analytics_file=config.get('analytics_file', ''),
+            sinks=make_sinks(
+                klant_nummer, slack_webhook_url,
+                config.get(
+                    'slack_channel_webhook_url', SLACK_CHANNEL_WEBHOOK_URL),
+                config.get('jsonl_file', JSONL_FILE),
+                config.get('webhook_url', WEBHOOK_URL),
+                config.get('syslog_address', SYSLOG_ADDRESS)))
+
+    def fetch_page(self):
+        with suppress(FileNotFoundError):
+            os.unlink(self.cache_filename)
+        return fetch(
+            self.klant_nummer, self.klant_gecrypt, self.cache_filename)
+
+    def fetch_logs(self, since=None):
+        """
+        Fetch and parse the records. Returns None if the history table is
+        identical to the one of the last call.
+        """
+        try:
+            data = self.fetch_page()
+            fingerprint = table_fingerprint(data)
+            self.save_snapshot(data, fingerprint)
+            if fingerprint == self.last_fingerprint:
+                return None
+            with METRICS.timer(
+                    'log2slack_parse_seconds', account=self.klant_nummer):
+                records = list(parse_logs(data, since))
+        except Exception:
+            # Start over with a fresh login on the next attempt.
+            reset_sessions(self.klant_nummer)
+            raise
+        self.last_fingerprint = fingerprint
+        return records
+
+    def save_snapshot(self, html_doc, fingerprint=None):
+        if self.snapshots is None:
+            return
+        try:
+            filename = self.snapshots.save(html_doc, fingerprint)
+        except OSError:
+            # Not being able to archive should not stop the alerts.
+            print_exc()
+        else:
+            if filename is not None:
+                print(f'[{self}] saved snapshot {filename}')
+
+    def save_history(self, records):
+        if self.history is None or not records:
+            return
+        try:
+            added = self.history.add(self, records)
+        except Exception:
+            # Not being able to archive should not stop the alerts.
+            print_exc()
+        else:
+            METRICS.inc(
+                'log2slack_history_records_total', added, account=str(self))
+
+    def poll(self):
+        """
+        Fetch the logs once and publish the new records. Raises on
+        fetch/parse failure; the caller decides when to retry.
+        """
+        self.publish(self.collect())
+
+    def collect(self):
+        """
+        Fetch the logs once and return the records not seen before.
+        """
+        data = self.fetch_logs(
+            since=(self.high_water.datetime if self.high_water else None))
+        if data is None:
+            self.unchanged_polls += 1
+            print(
+                f'[{self}] history unchanged, skipped parsing '
+                f'({self.unchanged_polls} times so far)')
+            METRICS.inc('log2slack_unchanged_polls_total', account=str(self))
+            return set()
+
+        data = set(data)
+        self.save_history(data)
+        not_published_yet = (data - self.already_published)
+        print(f'[{self}] data count: {len(data)}, new: {not_published_yet}')
+        METRICS.inc(
+            'log2slack_records_seen_total', len(data), account=str(self))
+        METRICS.inc(
+            'log2slack_records_new_total', len(not_published_yet),
+            account=str(self))
+        self.schedule.observe(not_published_yet)
+        if data:
+            # Keep the records of the high water mark second around,
+            # we'll see them again the next time.
+            self.already_published = data
+            self.high_water = max(data, key=AlarmRecord.SORT_KEY)
+
+        return not_published_yet
+
+    def publish(self, records):
+        """
+        Queue the records to the sinks. Sinks that run on their own
+        thread (start_sinks) deliver in the background, the others are
+        flushed here.
+        """
+        ledger = self.ledger
+        if self.analytics is not None:
+            try:
+                for digest in self.analytics.update(records):
+                    # Text for people: not for the record sinks.
+                    for sink in self.sinks:
+                        if isinstance(sink, SlackOutbox):
+                            sink.put(digest)
+            except Exception:
+                # Not being able to do the stats should not stop the alerts.
+                print_exc()
+
+        a_while_ago = AlarmRecord.to_timestamp(
+            datetime.datetime.now() - PUBLISH_LOOKBACK)
+        for record in sorted(records, key=AlarmRecord.SORT_KEY):
+            if record.timestamp < a_while_ago:
+                print(f'[{self}] skipping old: {record}')
+                METRICS.inc(
+                    'log2slack_records_skipped_old_total', account=str(self))
+                continue
+            if ledger is not None:
+                with self._ledger_lock:
+                    published = (record in ledger)
+                if published:
+                    print(f'[{self}] skipping published: {record}')
+                    continue
+            message = str(record)
+            for sink in self.sinks:
+                sink.put(message, record)
+
+        for sink in self.sinks:
+            if not sink.running:
+                sink.flush()
+            print(f'[{self}] {sink.status()}')
+
+        if ledger is not None:
+            # One fsync per cycle, for what the outbox delivered since the
+            # last one.
+            with self._ledger_lock:
+                ledger.commit()
+
+    def delivered(self, records):
+        """
+        Called (from the thread of the main Slack outbox, if started) with
+        the records Slack accepted. Only that sink marks them published;
+        the ledger is fsync'ed once per cycle, at the end of publish().
+        """
+        with self._ledger_lock:
+            for record in records:
+                print(f'[{self}] sent message: {record}')
+                METRICS.inc('log2slack_records_sent_total', account=str(self))
+                if self.ledger is not None:
+                    self.ledger.add(record)
+
+    def start_sinks(self):
+        for sink in self.sinks:
+            sink.start()
+
+
+def history_main(args):
+    """
+    history [--db FILE] [--account E..] [--event EVENT] [--group GROUP]
+            [--since DATE] [--until DATE] [--days N] [--abnormal]
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='history', description='query the HISTORY_DB')
+    parser.add_argument('--db', default=HISTORY_DB)
+    parser.add_argument('--account')
+    parser.add_argument('--event', help='e.g. ALARM_OFF')
+    parser.add_argument('--group')
+    parser.add_argument(
+        '--since', type=datetime.datetime.fromisoformat,
+        help='YYYY-MM-DD[ HH:MM:SS]')
+    parser.add_argument(
+        '--until', type=datetime.datetime.fromisoformat,
+        help='YYYY-MM-DD[ HH:MM:SS] (exclusive)')
+    parser.add_argument('--days', type=int, help='only the last N days')
+    parser.add_argument(
+        '--abnormal', action='store_true',
+        help='only events other than the AlarmRecord.NORMAL_EVENTS')
+    args = parser.parse_args(args)
+    if not args.db:
+        parser.error('no --db or HISTORY_DB')
+
+    since = args.since
+    if args.days is not None:
+        since = max(filter(None, (since, (
+            datetime.datetime.now() - datetime.timedelta(days=args.days)))))
+
+    import sqlite3
+
+    t0 = time.perf_counter()
+    try:
+        store = HistoryStore(args.db, read_only=True)
+    except sqlite3.OperationalError as e:
+        parser.error(f'cannot open {args.db}: {e}')
+    rows = store.query(
+        account=args.account, event=args.event, group=args.group,
+        since=since, until=args.until, abnormal=args.abnormal)
+    td = time.perf_counter() - t0
+    for account, record in rows:
+        print(f'[{account}] {record}')
+    print(f'# {len(rows)} records in {td * 1000:.1f} ms')
+
+
+def load_accounts():
+    """
+    Load the accounts from the ACCOUNTS_FILE (a JSON list of dicts with
+    at least klant_nummer and klant_code) or, if unset, the single
+    account from the KLANT_* environment.
+    """
+    if ACCOUNTS_FILE == '':
+        return [Account.from_environ()]
+    with open(ACCOUNTS_FILE) as fp:
+        return [Account.from_config(i) for i in json.load(fp)]
+
+
+class PollSchedule:
+    """
+    Keeps track of when to poll an account next.
+
+    The poll interval adapts to the activity: after alarm activity (an
+    arm/disarm or any non-NORMAL_EVENTS record) we poll every
+    POLL_INTERVAL_MIN for POLL_ACTIVE_PERIOD. Then the interval doubles
+    every poll until it is back at SLEEP_AFTER_FETCH, or at
+    POLL_INTERVAL_MAX during the POLL_NIGHT_HOURS.
+
+    Failures are retried with backoff, behind a circuit breaker: see
+    RETRY_BACKOFF_MIN and CIRCUIT_MAX_FAILURES. An open circuit is kept
+    in the state_file (if set), so a restart does not notify again.
+    """
+    ACTIVE_EVENTS = ('ALARM_ON', 'ALARM_OFF')
+    jitter = POLL_JITTER
+
+    def __init__(self, account, state_file=''):
+        self.account = account
+        self.state_file = state_file
+        self.failing_since = None
+        self.failures = 0  # network/auth failures in a row
+        self.parse_failures = 0  # in a row
+        self.circuit_open = False  # if open, the next poll is a probe
+        self.outage_since = None  # when the circuit opened
+        self.active_until = None
+        self.interval = SLEEP_AFTER_FETCH  # the effective interval
+        if state_file:
+            with suppress(FileNotFoundError, ValueError):
+                with open(state_file) as fp:
+                    self.outage_since = float(fp.read())
+                self.circuit_open = True
+
+    def observe(self, records):
+        for record in records:
+            if (record.event in self.ACTIVE_EVENTS or
+                    record.event not in AlarmRecord.NORMAL_EVENTS):
+                active_until = record.datetime + datetime.timedelta(
+                    seconds=POLL_ACTIVE_PERIOD)
+                if self.active_until is None or (
+                        active_until > self.active_until):
+                    self.active_until = active_until
+
+    def next_interval(self, now=None):
+        if now is None:
+            now = datetime.datetime.now()
+
+        night_start, night_end = POLL_NIGHT_HOURS
+        if self.active_until is not None and now < self.active_until:
+            target = POLL_INTERVAL_MIN
+        elif night_start <= now.hour < night_end:
+            target = POLL_INTERVAL_MAX
+        else:
+            target = SLEEP_AFTER_FETCH
+
+        if target < self.interval:
+            interval = target
+        else:
+            interval = min(target, 2 * self.interval)
+        self.interval = max(
+            POLL_INTERVAL_MIN, min(POLL_INTERVAL_MAX, interval))
+        return self.interval * (1 + self.jitter * random.uniform(-1, 1))
+
+    def succeeded(self):
+        """
+        Returns the seconds until the next poll.
+        """
+        if self.circuit_open:
+            self.notify(
+                f':white_check_mark: alarm portal reachable again for '
+                f'{self.account}, after '
+                f'{int(time.time() - self.outage_since)} seconds')
+            self.circuit_open = False
+            self.outage_since = None
+            if self.state_file:
+                with suppress(FileNotFoundError):
+                    os.unlink(self.state_file)
+            METRICS.set(
+                'log2slack_circuit_open', 0, account=str(self.account))
+        self.failing_since = None
+        self.failures = 0
+        self.parse_failures = 0
+        touch_health_file()
+        METRICS.set(
+            'log2slack_last_success_timestamp_seconds', time.time(),
+            account=str(self.account))
+        interval = self.next_interval()
+        METRICS.set(
+            'log2slack_poll_interval_seconds', self.interval,
+            account=str(self.account))
+        print(f'[{self.account}] # next poll in {interval:.0f} seconds')
+        return interval
+
+    def failed(self, exc=None):
+        """
+        Returns the seconds until the next (retry) poll.
+        """
+        kind = classify_failure(exc)
+        if self.failing_since is None:
+            self.failing_since = time.time()
+        td = time.time() - self.failing_since
+        METRICS.inc(
+            'log2slack_poll_failures_total', account=str(self.account),
+            kind=kind)
+
+        if kind == 'parse':
+            # Our bug (or a portal change we do not handle), not an
+            # outage: keep it out of the circuit breaker, but be loud.
+            self.parse_failures += 1
+            count = self.parse_failures
+            delay = min(
+                CIRCUIT_OPEN_TIME, SLEEP_AFTER_FAIL * 2 ** (count - 1))
+            print(
+                f'[{self.account}] # PARSE FAILURE: {exc!r}. A bug, or the '
+                f'portal changed its pages: fix the parser!')
+        else:
+            self.failures += 1
+            count = self.failures
+            delay = self.failure_delay(kind, exc)
+        # Half to full delay, so accounts (and restarts) do not retry in
+        # lockstep.
+        delay *= random.uniform(0.5, 1)
+        # Failing with a retry scheduled is the breaker at work: /healthz
+        # stays healthy until the retry is overdue.
+        retry = time.time() + delay
+        METRICS.set(
+            'log2slack_retry_timestamp_seconds', retry,
+            account=str(self.account))
+
+        print(
+            f'[{self.account}] # {kind} failure {count} '
+            f'(for {int(td)} seconds'
+            f'{", circuit open" if self.circuit_open else ""}), '
+            f'retrying after {delay:.0f}')
+        return delay
+
+    def failure_delay(self, kind, exc):
+        """
+        The (full) delay after a network or auth failure. Opens the
+        circuit after CIRCUIT_MAX_FAILURES of them.
+        """
+        if self.failures >= CIRCUIT_MAX_FAILURES:
+            # Open, or a failed probe: open again, for longer.
+            opened = self.failures - CIRCUIT_MAX_FAILURES
+            delay = min(MAX_FAIL_TIME, CIRCUIT_OPEN_TIME * 2 ** opened)
+            if not self.circuit_open:
+                self.circuit_open = True
+                self.outage_since = self.failing_since
+                if self.state_file:
+                    with open(self.state_file, 'w') as fp:
+                        fp.write(str(self.outage_since))
+                METRICS.set(
+                    'log2slack_circuit_open', 1, account=str(self.account))
+                self.notify(
+                    f':warning: alarm portal failing for {self.account} '
+                    f'({kind}: {str(exc)[:200]}), no alarms until it '
+                    f'recovers')
+        elif kind == 'network':
+            delay = min(
+                SLEEP_AFTER_FAIL,
+                RETRY_BACKOFF_MIN * 2 ** (self.failures - 1))
+        else:
+            delay = min(
+                CIRCUIT_OPEN_TIME,
+                SLEEP_AFTER_FAIL * 2 ** (self.failures - 1))
+        return delay
+
+    def notify(self, message):
+        """
+        Post a status notice to the Slack webhook of the account: queue it
+        to its Slack outbox, whose thread (or the next publish()) delivers
+        it, with the usual retries.
+        """
+        print(f'[{self.account}] # notice: {message}')
+        self.account.outbox.put(message)
+
+
+def all_failing(accounts, now=None):
+    """
+    Whether every account has been failing for longer than MAX_FAIL_TIME.
+    Then we give up: exit non-zero, so the supervisor restarts us, also
+    when no liveness probe is set up.
+    """
+    if now is None:
+        now = time.time()
+    return all(
+        account.schedule.failing_since is not None and
+        now - account.schedule.failing_since > MAX_FAIL_TIME
+        for account in accounts)
+
+
+def touch_health_file():
+    # Alive if at least one account does its work. The liveness probe
+    # restarts us if none do.
+    if HEALTH_FILE != '':
+        os.utime(HEALTH_FILE)
+
+
+class PollEngine:
+    """
+    Polls a list of accounts concurrently on a bounded thread pool.
+
+    Every account is scheduled on its own: a failing account is retried
+    with backoff without holding up the others.
+    """
+    def __init__(self, accounts, max_workers=POLL_WORKERS):
+        self.accounts = accounts
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='poll')
+        self.next_poll = dict((account, 0) for account in accounts)
+        self.running = {}  # future -> account
+
+    def step(self, timeout=1):
+        now = time.time()
+        busy = set(self.running.values())
+        for account in self.accounts:
+            if account not in busy and self.next_poll[account] <= now:
+                self.running[self.executor.submit(account.poll)] = account
+
+        if not self.running:
+            time.sleep(max(0, min(
+                [timeout] + [i - now for i in self.next_poll.values()])))
+            return
+
+        done, not_done = wait(
+            self.running, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            account = self.running.pop(future)
+            try:
+                future.result()
+            except Exception as e:
+                print_exc()
+                delay = account.schedule.failed(e)
+            else:
+                delay = account.schedule.succeeded()
+            self.next_poll[account] = time.time() + delay
+        if done and all_failing(self.accounts):
+            sys.exit(f'# all accounts failing for over {MAX_FAIL_TIME} '
+                     f'seconds, giving up')
 
+    def run_forever(self):
+        while True:
+            self.step()
 
-def fix_dicts_who_did_what(data):
-    """
-    The dict has info in a higher up event. Or sometimes lower..
 
-    [{'Aansluiting': 'E0123456',
-      'Alrm': 'INF',
-      'Groep': '6',
-      'Omschrijving': 'UITGESCH. JOHN',
-      'Sector': '0',
-      'Tijd': datetime.datetime(2001, 11, 22, 8, 45, 27)},
-     {'Aansluiting': 'E0123456',
-      'Alrm': 'UIT',
-      'Groep': '6',
-      'Omschrijving': 'Uit',
-      'Sector': '0',
-      'Tijd': datetime.datetime(2001, 11, 22, 8, 45, 27)}]
+class AsyncPollEngine:
     """
-    new_data = []
-    info = None
-    last_row = None
-    for row in data:
-        if row['Alrm'] == 'INF':
-            if last_row is not None and (
-                    last_row.get('Aansluiting') == row.get('Aansluiting') and
-                    last_row['Groep'] == row['Groep'] and
-                    last_row['Sector'] == row['Sector'] and
-                    last_row['Tijd'] == row['Tijd']):
-                last_row['Info'] = row['Omschrijving']
-            else:
-                info = row
-        elif info is not None:
-            assert row.get('Aansluiting') == info.get('Aansluiting'), (row, info)
-            assert row['Groep'] == info['Groep'], (row, info)
-            assert row['Sector'] == info['Sector'], (row, info)
-            assert row['Tijd'] == info['Tijd'], (row, info)
-            row['Info'] = info['Omschrijving']
-            info = None
-            new_data.append(row)
-            last_row = None
-        else:
-            new_data.append(row)
-            last_row = row
-    return new_data
+    asyncio version of the PollEngine.
 
+    Fetching/parsing and Slack delivery are separate tasks per account,
+    joined by a queue, so a slow webhook does not delay the next portal
+    poll and a slow portal does not delay alerts of other accounts. The
+    blocking HTTP calls are run in the default executor. All waits are
+    cut short by stop() (SIGINT/SIGTERM), for a quick shutdown.
+    """
+    def __init__(self, accounts):
+        self.accounts = accounts
+        self.loop = None
+        self.stopping = None  # asyncio.Event, once running
+        self.gave_up = False  # stopped because all accounts are failing
 
-def to_records(data):
-    new_data = []
-    assert all(
-        i.get('Aansluiting') == data[0].get('Aansluiting') for i in data), data
-    for row in data:
-        event = {
-                'IN': 'ALARM_ON',
-                'UIT': 'ALARM_OFF',
-                '24H': '24H',                       # ?, always "AUTOTEST"
-                # The following concern the known times in which the
-                # alarm may be switched on/off.
-                'TVU': 'UNEXPECT_ALARM_OFF',        # "Te Vroeg Uitgeschakeld"
-                'TLI': 'UNEXPECT_NO_ALARM_YET',     # "Te Laat Ingeschakeld"
-                'AFW': 'OVERRIDE_ALARM_TIME',       # Afwijkende tijd(?)
-            }.get(
-            row['Alrm'], row['Alrm'])
-
-        extra = row['Info'] if 'Info' in row else ''
-        if row['Omschrijving']:
-            if extra and extra != ':':
-                extra += f' ({row["Omschrijving"]})'
-            else:
-                extra = row['Omschrijving']
+    def stop(self):
+        # Thread-safe, may also be called from the executor threads.
+        print('# stopping...')
+        self.loop.call_soon_threadsafe(self.stopping.set)
 
-        new_data.append(AlarmRecord(
-            datetime=row['Tijd'], event=(event or '(log)'), group=row['Groep'],
-            sector=row['Sector'], extra=extra))
-    return new_data
+    async def sleep(self, seconds):
+        import asyncio
 
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self.stopping.wait(), seconds)
 
-def fetch(klant_nummer, klant_gecrypt):
-    try:
-        with open(CACHE_FILENAME) as fp:
-            data = fp.read()
-    except Exception:
-        # Leave exception handler so we won't see this as cause later on.
-        data = ''
+    async def fetcher(self, account, queue):
+        import asyncio
 
-    if 'Recent ontvangen meldingen:' not in data:
-        data = login_and_fetch(klant_nummer, klant_gecrypt)
-        with open(CACHE_FILENAME, 'w') as fp:
-            fp.write(data)
+        while not self.stopping.is_set():
+            try:
+                records = await asyncio.to_thread(account.collect)
+            except Exception as e:
+                print_exc()
+                delay = account.schedule.failed(e)
+                if all_failing(self.accounts):
+                    print(f'# all accounts failing for over '
+                          f'{MAX_FAIL_TIME} seconds, giving up')
+                    self.gave_up = True
+                    self.stop()
+            else:
+                await queue.put(records)
+                delay = account.schedule.succeeded()
+            await self.sleep(delay)
+        await queue.put(None)
 
-    return data
+    async def publisher(self, account, queue):
+        import asyncio
 
+        while True:
+            records = await queue.get()
+            if records is None:
+                break
+            try:
+                await asyncio.to_thread(account.publish, records)
+            except Exception:
+                print_exc()
 
-def fetch_logs():
-    data = fetch(KLANT_NUMMER, KLANT_GECRYPT)
-    data = html_table_to_dicts(data)
-    data = fix_dicts_datetime(data)
-    data = fix_dicts_who_did_what(data)
-    data = to_records(data)
-    # data = [i for i in data if i.event in ('ALARM_ON', 'ALARM_OFF')]
-    # os.unlink(CACHE_FILENAME)
-    return data
+    async def run(self):
+        import asyncio
 
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            with suppress(NotImplementedError, RuntimeError):
+                self.loop.add_signal_handler(signum, self.stop)
 
-def fetch_logs_with_retry():
-    t0 = time.time()
-    while True:
-        with suppress(FileNotFoundError):
-            os.unlink(CACHE_FILENAME)
-        try:
-            return fetch_logs()
-        except Exception:
-            td = time.time() - t0
-            if td >= MAX_FAIL_TIME:
-                raise
-            print_exc()
-            print(f'# retrying after {SLEEP_AFTER_FAIL}')
-            time.sleep(SLEEP_AFTER_FAIL)
-    raise NotImplementedError()
+        tasks = []
+        for account in self.accounts:
+            queue = asyncio.Queue()
+            tasks.append(asyncio.create_task(self.fetcher(account, queue)))
+            tasks.append(asyncio.create_task(self.publisher(account, queue)))
+        await asyncio.gather(*tasks)
 
 
-def fetch_logs_and_publish_forever():
-    already_published = set()
+def start_publishing(accounts=None):
+    """
+    Common startup of the poll engines. Returns the accounts.
+    """
+    if accounts is None:
+        accounts = load_accounts()
 
     if HEALTH_FILE != '':
         with open(HEALTH_FILE, 'w'):
             pass
+    if METRICS_PORT != '':
+        start_metrics_server(int(METRICS_PORT))
+    for account in accounts:
+        account.start_sinks()
+    return accounts
 
-    while True:
-        data = set(fetch_logs_with_retry())
-        not_published_yet = (data - already_published)
-        print(f'data count: {len(data)}, new: {not_published_yet}')
-        already_published = data
 
-        a_while_ago = (datetime.datetime.now() - datetime.timedelta(hours=4))
-        for record in sorted(not_published_yet, key=AlarmRecord.SORT_KEY):
-            if record.datetime < a_while_ago:
-                print(f'skipping old: {record}')
-            else:
-                send_slack_message(str(record))
-                print(f'sent message: {record}')
+def fetch_logs_and_publish_forever(accounts=None):
+    accounts = start_publishing(accounts)
+    PollEngine(accounts).run_forever()
+
 
-        if HEALTH_FILE != '':
-            os.utime(HEALTH_FILE)
+def fetch_logs_and_publish_forever_async(accounts=None):
+    import asyncio
 
-        time.sleep(300)
+    accounts = start_publishing(accounts)
+    engine = AsyncPollEngine(accounts)
+    asyncio.run(engine.run())
+    if engine.gave_up:
+        sys.exit(1)
 
 
 def test():
@@ -429,6 +2817,97 @@ def test():
     Hide the tests inside this function. Only load/parse this when called.
     """
     import unittest
+    from unittest import mock
+
+    def coalesce_records(data):
+        return list(iter_coalesce_records(data))
+
+    def patch_global(name, value):
+        # The module globals the code reads, also when run as __main__.
+        return mock.patch.object(sys.modules[__name__], name, value)
+
+    class FakeResponse:
+        """
+        A requests.Response with the given body (str or bytes), streamed
+        in chunks of chunk_size, or of the size asked for.
+        """
+        encoding = 'utf-8'
+
+        def __init__(self, body='', status_code=200, headers=None,
+                     chunk_size=None):
+            self.content = (
+                body.encode('utf-8') if isinstance(body, str) else body)
+            self.text = self.content.decode('utf-8')
+            self.status_code = status_code
+            self.headers = headers or {}
+            self.chunk_size = chunk_size
+
+        def iter_content(self, chunk_size):
+            chunk_size = self.chunk_size or chunk_size
+            for i in range(0, len(self.content), chunk_size):
+                yield self.content[i:(i + chunk_size)]
+
+        def close(self):
+            pass
+
+    class FakeSession:
+        """
+        A requests.Session that answers with the next of the responses
+        (bodies), and appends (method, url) to requests_done.
+        """
+        cookies = {}
+
+        def __init__(self, responses, requests_done):
+            self.responses = responses
+            self.requests_done = requests_done
+
+        def get(self, url, timeout, **kwargs):
+            self.requests_done.append(('GET', url))
+            return FakeResponse(self.responses.pop(0))
+
+        def post(self, url, data, timeout):
+            self.requests_done.append(('POST', url))
+            return FakeResponse(self.responses.pop(0))
+
+        def close(self):
+            pass
+
+    class FakeSchedule(PollSchedule):
+        """
+        A PollSchedule that keeps its notices, instead of posting them.
+        """
+        def __init__(self, account, state_file=''):
+            super().__init__(account, state_file)
+            self.notices = []
+
+        def notify(self, message):
+            self.notices.append(message)
+
+    class FakeAccount(Account):
+        """
+        An Account that polls the next of its pages (raising it, if an
+        exception) and keeps what it publishes, per poll.
+        """
+        def __init__(self, klant_nummer='E123456', pages=(), **kwargs):
+            super().__init__(
+                klant_nummer, 'x', 'http://slack.invalid/', **kwargs)
+            self.pages = list(pages)
+            self.published = []
+            self.schedule = FakeSchedule(self)
+
+        def fetch_page(self):
+            page = self.pages.pop(0)
+            if isinstance(page, Exception):
+                raise page
+            return page
+
+        def publish(self, records):
+            self.published.append(records)
+
+    def fresh_metrics(test):
+        # The gauges (success/failure times) a test sets must not leak
+        # into the health checks of other tests.
+        return mock.patch.object(METRICS, 'gauges', {})(test)
 
     class AllTests(unittest.TestCase):
         maxDiff = None
@@ -1062,6 +3541,941 @@ def test():
             # data = [i for i in data if i.event in ('ALARM_ON', 'ALARM_OFF')]
             # os.unlink(CACHE_FILENAME)
 
+        def test_html_table_to_dicts_same_as_bs4(self):
+            for filename in (
+                    'test_status_1.html', 'test_status_2.html',
+                    'test_status_3.html', 'test_status_4.html'):
+                with open(filename) as fp:
+                    data = fp.read()
+                expected_data = html_table_to_dicts_bs4(data)
+                self.assertEqual(expected_data, html_table_to_dicts(data))
+                # Small chunks, to check that split tags/text are handled.
+                self.assertEqual(
+                    expected_data,
+                    list(iter_html_table_rows(data, chunk_size=7)))
+
+        def test_history_store(self):
+            import tempfile
+            from contextlib import redirect_stderr
+
+            with open('test_status_3.html') as fp:
+                records = list(parse_logs(fp.read()))
+            with tempfile.TemporaryDirectory() as tmpdir:
+                filename = os.path.join(tmpdir, 'history.sqlite3')
+                store = HistoryStore(filename)
+                self.assertEqual(
+                    store.add('E1', records), len(records))
+                self.assertEqual(store.add('E1', records), 0)  # seen
+                self.assertEqual(store.add('E2', records[:2]), 2)
+                store.close()
+
+                store = HistoryStore(filename)
+                rows = store.query(account='E1')
+                self.assertEqual(
+                    [i[1] for i in rows],
+                    sorted(records, key=AlarmRecord.SORT_KEY))
+                rows = store.query(
+                    event='ALARM_OFF', group='7',
+                    since=datetime.datetime(2025, 1, 14),
+                    until=datetime.datetime(2025, 1, 15))
+                self.assertEqual(
+                    [str(i[1]) for i in rows],
+                    ['2025-01-14 08:41:01: ALARM_OFF (G7/S0): by charlie'])
+                self.assertEqual(
+                    [i[1].event for i in store.query(abnormal=True)], [])
+                store.close()
+
+                store = HistoryStore(filename, read_only=True)
+                self.assertEqual(len(store.query(account='E2')), 2)
+                store.close()
+
+                # A mistyped --db is an error, not an empty new database.
+                typo = os.path.join(tmpdir, 'histroy.sqlite3')
+                with open(os.devnull, 'w') as devnull, \
+                        redirect_stderr(devnull), \
+                        self.assertRaises(SystemExit):
+                    history_main(['--db', typo])
+                self.assertFalse(os.path.exists(typo))
+
+        def test_arming_analytics(self):
+            import tempfile
+
+            with open('test_status_3.html') as fp:
+                records = list(parse_logs(fp.read()))
+            with tempfile.TemporaryDirectory() as tmpdir:
+                filename = os.path.join(tmpdir, 'analytics.json')
+                analytics = ArmingAnalytics(filename, 'daily')
+                analytics.state = analytics.new_state(
+                    analytics.timestamp(datetime.datetime(2025, 1, 14)))
+
+                # The first record of the 15th completes the 14th.
+                digests = analytics.update(
+                    records, now=datetime.datetime(2025, 1, 15, 18))
+                self.assertEqual(digests, [
+                    ':bar_chart: daily alarm digest, '
+                    '2025-01-14 00:00 - 2025-01-15 00:00\n'
+                    'G7: armed 25% (5h 54m), 1x on, 1x off\n'
+                    'users: charlie 1x on/1x off\n'
+                    'armed on average at 18:05'])
+                # Seen before: no-op.
+                self.assertEqual(analytics.update(
+                    records, now=datetime.datetime(2025, 1, 15, 18)), [])
+
+                # Continue from the saved state; the clock completes the
+                # 15th.
+                analytics = ArmingAnalytics(filename, 'daily')
+                digests = analytics.update(
+                    [], now=datetime.datetime(2025, 1, 16, 1))
+                self.assertEqual(digests, [
+                    ':bar_chart: daily alarm digest, '
+                    '2025-01-15 00:00 - 2025-01-16 00:00\n'
+                    'G7: armed 100% (1d 0h), 1x on, 0x off\n'
+                    'G8: armed 0% (0m), 0x on, 1x off\n'
+                    'users: charlie 1x on/0x off, frank 0x on/1x off\n'
+                    'armed on average at 17:55 (10m earlier than before)'])
+
+                # A torn state file: start over instead of crashing.
+                with open(filename, 'w') as fp:
+                    fp.write('{"period_start": 17')
+                analytics = ArmingAnalytics(filename, 'daily')
+                self.assertEqual(analytics.state['groups'], {})
+
+        def test_published_ledger(self):
+            from tempfile import TemporaryDirectory
+            now = datetime.datetime.now().replace(microsecond=0)
+            old_record = AlarmRecord(
+                datetime=(now - datetime.timedelta(hours=5)),
+                event='ALARM_ON', group='6', sector='0',
+                extra='VOLL. ING BOB (In)')
+            new_record = AlarmRecord(
+                datetime=now, event='ALARM_OFF', group='6', sector='0',
+                extra='UITGESCH. BOB (Uit)')
+
+            with TemporaryDirectory() as tmpdir:
+                filename = os.path.join(tmpdir, 'ledger')
+                ledger = PublishedLedger(filename)
+                ledger.add(old_record)
+                ledger.add(new_record)
+                ledger.commit()
+                self.assertNotIn(old_record, ledger)  # outside window
+                self.assertIn(new_record, ledger)
+                ledger.close()
+
+                # A restart only loads the records inside the window and
+                # compacts the file.
+                ledger = PublishedLedger(filename)
+                self.assertEqual(
+                    list(ledger.records.values()), [new_record])
+                with open(filename) as fp:
+                    self.assertEqual(
+                        fp.read(), PublishedLedger.record_to_line(new_record))
+                ledger.close()
+
+                # Written before we merged the (log) records into the
+                # X-M/Y-M ones: still published.
+                maintenance = AlarmRecord(
+                    datetime=now, event='Y-M', group='', sector='0',
+                    extra='Einde test Monteur')
+                with open(filename, 'a') as fp:
+                    fp.write(PublishedLedger.record_to_line(maintenance))
+                ledger = PublishedLedger(filename)
+                self.assertIn(AlarmRecord(
+                    datetime=now, event='Y-M', group='', sector='0',
+                    extra='Einde test Monteur (Gebr.: Mark)'), ledger)
+                self.assertNotIn(AlarmRecord(
+                    datetime=now, event='X-M', group='', sector='0',
+                    extra='Begin test Monteur (Gebr.: Mark)'), ledger)
+                ledger.close()
+
+        def test_parse_logs(self):
+            for filename in (
+                    'test_status_1.html', 'test_status_2.html',
+                    'test_status_3.html', 'test_status_4.html'):
+                with open(filename) as fp:
+                    data = fp.read()
+                expected_data = coalesce_records(to_records(
+                    fix_dicts_who_did_what(fix_dicts_datetime(
+                        html_table_to_dicts_bs4(data)))))
+                self.assertEqual(expected_data, list(parse_logs(data)))
+
+        def test_coalesce_records(self):
+            with open('test_status_2.html') as fp:
+                data = fp.read()
+            records = list(parse_logs(data))
+            self.assertEqual(len(records), len(to_records(
+                fix_dicts_who_did_what(fix_dicts_datetime(
+                    html_table_to_dicts(data))))) - 4)
+            self.assertEqual(
+                [str(i) for i in records if i.event in ('X-M', 'Y-M')], [
+                    '2023-03-15 13:54:51: Y-M (G/S0): Einde test Monteur '
+                    '(Gebr.: Mark Evert Chaniciën; '
+                    'Resultaat : Test volgens plan verlopen) <-- <!channel>',
+                    '2023-03-15 11:48:50: X-M (G/S0): Begin test Monteur '
+                    '(Gebr.: Mark Evert Chaniciën; '
+                    'Reden : Periodiek Onderhoud) <-- <!channel>'])
+            self.assertNotIn('(log)', [i.event for i in records])
+
+            # Other sector, other time or no X-M/Y-M: left alone.
+            dt = datetime.datetime(2023, 3, 15, 11, 48, 50)
+            later = dt + datetime.timedelta(seconds=1)
+            records = [
+                AlarmRecord(dt, '(log)', '', '1', 'Gebr.: X'),
+                AlarmRecord(dt, 'X-M', '', '0', 'Begin test Monteur'),
+                AlarmRecord(later, '(log)', '', '0', 'Gebr.: X'),
+                AlarmRecord(later, '(log)', '', '0', 'Reden : Y')]
+            self.assertEqual(coalesce_records(records), records)
+
+        def test_fix_dicts_who_did_what_inf_after(self):
+            # INF after the row it belongs to, at the end of the table.
+            rows = [
+                {'Alrm': 'UIT', 'Groep': '6', 'Omschrijving': 'Uit',
+                 'Sector': '0', 'Tijd': 1},
+                {'Alrm': 'INF', 'Groep': '6', 'Omschrijving': 'UITGESCH. BOB',
+                 'Sector': '0', 'Tijd': 1}]
+            self.assertEqual(
+                list(iter_fix_dicts_who_did_what(iter(rows))),
+                [{'Alrm': 'UIT', 'Groep': '6', 'Info': 'UITGESCH. BOB',
+                  'Omschrijving': 'Uit', 'Sector': '0', 'Tijd': 1}])
+
+        def test_take_rows_since(self):
+            with open('test_status_3.html') as fp:
+                data = fp.read()
+
+            since = datetime.datetime(2025, 1, 15, 8, 29, 32)
+            data = list(parse_logs(data, since))
+            self.assertEqual(
+                [(i.datetime, i.event) for i in data],
+                [(datetime.datetime(2025, 1, 15, 17, 55, 50), 'ALARM_ON'),
+                 (datetime.datetime(2025, 1, 15, 10, 10, 58), '24H'),
+                 (datetime.datetime(2025, 1, 15, 8, 29, 32), 'ALARM_OFF')])
+
+        def test_slack_outbox(self):
+            posted = []
+            responses = [429, 500, 200, 200]
+
+            class FakeOutbox(SlackOutbox):
+                def post(self, message):
+                    ret = FakeResponse(
+                        status_code=responses.pop(0),
+                        headers={'Retry-After': '0'})
+                    if ret.status_code == 200:
+                        posted.append(message)
+                    return ret
+
+            outbox = FakeOutbox('http://slack.invalid/', max_length=24)
+            outbox.put('message one', 1)
+            outbox.put('message two', 2)
+            outbox.put('message three', 3)
+            self.assertEqual(len(outbox), 3)
+            # No sleep on the backoff of the 500 error please.
+            with mock.patch('time.sleep'):
+                delivered = outbox.flush()
+            self.assertEqual(delivered, [1, 2, 3])
+            self.assertEqual(
+                posted, ['message one\nmessage two', 'message three'])
+            self.assertEqual(len(outbox), 0)
+            self.assertEqual(outbox.sent, 3)
+            self.assertFalse(outbox.gave_up)
+
+            # Failures keep the messages in the queue.
+            responses.append(500)
+            outbox.put('message four', 4)
+            self.assertEqual(outbox.flush(max_attempts=1), [])
+            self.assertEqual(len(outbox), 1)
+            self.assertTrue(outbox.gave_up)
+
+        def test_sinks(self):
+            import socket
+            import tempfile
+
+            with open('test_status_2.html') as fp:
+                records = set(parse_logs(fp.read()))
+            urgent = [
+                i for i in records
+                if i.event not in AlarmRecord.NORMAL_EVENTS]
+            self.assertTrue(urgent)
+            unblock = threading.Event()
+            delivered = []
+
+            class FakeSink(Sink):
+                def __init__(self, name, **kwargs):
+                    super().__init__(account='E1', **kwargs)
+                    self.name = name
+                    self.done = threading.Event()
+
+                def deliver(self, batch):
+                    if self.name == 'slow':
+                        unblock.wait()
+                    elif self.name == 'failing':
+                        self.done.set()
+                        raise OSError('down')
+                    delivered.extend((self.name, i[2]) for i in batch)
+                    if len(self.queue) == len(batch):
+                        self.done.set()
+
+            main, slow, failing, channel = (
+                FakeSink('main'), FakeSink('slow'), FakeSink('failing'),
+                FakeSink('channel', urgent_only=True))
+            lookback = patch_global(
+                'PUBLISH_LOOKBACK', datetime.timedelta(days=36500))
+            try:
+                with lookback, tempfile.TemporaryDirectory() as tmpdir:
+                    ledger_file = os.path.join(tmpdir, 'ledger')
+                    account = Account(
+                        'E1', 'x', 'http://slack.invalid/',
+                        ledger_file=ledger_file,
+                        sinks=[main, slow, failing, channel])
+                    ledgered = threading.Event()
+
+                    def on_delivered(records, delivered=main.on_delivered):
+                        delivered(records)
+                        if not main.queue:
+                            ledgered.set()
+
+                    main.on_delivered = on_delivered
+                    account.start_sinks()
+                    account.publish(records)  # does not wait for the sinks
+                    for sink in (main, failing, channel):
+                        self.assertTrue(sink.done.wait(5))
+                    self.assertTrue(ledgered.wait(5))
+                    # Marked published once, by the main sink only.
+                    with open(ledger_file) as fp:
+                        lines = fp.readlines()
+                    self.assertEqual(
+                        sorted(lines), sorted(
+                            PublishedLedger.record_to_line(i)
+                            for i in records))
+                    account.ledger.close()
+            finally:
+                unblock.set()
+
+            self.assertEqual(
+                [i[1] for i in delivered if i[0] == 'main'],
+                sorted(records, key=AlarmRecord.SORT_KEY))
+            self.assertEqual(
+                [i[1] for i in delivered if i[0] == 'channel'],
+                sorted(urgent, key=AlarmRecord.SORT_KEY))
+            self.assertEqual(main.sent, len(records))
+            self.assertGreaterEqual(failing.failures, 1)
+            self.assertIsInstance(failing.last_error, OSError)
+            self.assertEqual(len(failing), len(records))
+
+            # The JSON-lines and syslog sinks.
+            record = sorted(urgent, key=AlarmRecord.SORT_KEY)[0]
+            with tempfile.TemporaryDirectory() as tmpdir:
+                filename = os.path.join(tmpdir, 'out.jsonl')
+                sink = JsonLinesSink(filename, account='E1')
+                sink.put(str(record), record)
+                sink.put('notice')
+                self.assertEqual(sink.flush(), [record])
+                with open(filename) as fp:
+                    lines = [json.loads(i) for i in fp]
+            self.assertEqual(lines[0]['message'], str(record))
+            self.assertEqual(lines[0]['record']['event'], record.event)
+            self.assertEqual(lines[1], {'account': 'E1', 'message': 'notice'})
+
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server:
+                server.bind(('127.0.0.1', 0))
+                sink = SyslogSink(
+                    f'127.0.0.1:{server.getsockname()[1]}', account='E1')
+                sink.put(str(record), record)
+                self.assertEqual(sink.flush(), [record])
+                sink.sock.close()
+                self.assertEqual(
+                    server.recv(4096).decode(),
+                    f'<12>log2slack[E1]: {record}')
+
+        def test_notices_to_slack_only(self):
+            jsonl = JsonLinesSink(os.devnull, account='E1')
+            channel = SlackOutbox(
+                'http://slack.invalid/channel', account='E1',
+                urgent_only=True)
+            outbox = SlackOutbox('http://slack.invalid/', account='E1')
+            account = Account(
+                'E1', 'x', 'http://slack.invalid/',
+                sinks=[jsonl, channel, outbox])
+            self.assertIs(account.outbox, outbox)
+            account.schedule.notify(':warning: down')
+            self.assertEqual(
+                [i[1] for i in outbox.queue], [':warning: down'])
+            self.assertEqual((len(jsonl), len(channel)), (0, 0))
+
+            class FakeAnalytics:
+                def update(self, records):
+                    return [':bar_chart: digest']
+
+            outbox.queue.clear()
+            account.analytics = FakeAnalytics()
+            outbox.running = jsonl.running = channel.running = True
+            account.publish([])
+            self.assertEqual(
+                [i[1] for i in outbox.queue], [':bar_chart: digest'])
+            self.assertEqual((len(jsonl), len(channel)), (0, 0))
+
+        @fresh_metrics
+        def test_poll_engine_isolation(self):
+            with open('test_status_3.html') as fp:
+                page = fp.read()
+            good = FakeAccount('good', pages=[page])
+            bad = FakeAccount('bad', pages=[ValueError('login failed')])
+            engine = PollEngine([bad, good], max_workers=2)
+            while bad.schedule.failing_since is None or engine.running:
+                engine.step(timeout=0.1)
+            self.assertEqual((good.pages, bad.pages), ([], []))
+            self.assertEqual(len(good.published), 1)
+            self.assertIsNone(good.schedule.failing_since)
+            self.assertGreater(
+                engine.next_poll[good], engine.next_poll[bad])
+
+            # Once all accounts have been failing for too long, we give up.
+            self.assertFalse(all_failing([bad, good]))
+            for account in (bad, good):
+                account.pages.append(LoginError('x'))
+                account.schedule.failing_since = (
+                    time.time() - MAX_FAIL_TIME - 1)
+                engine.next_poll[account] = 0
+            with self.assertRaises(SystemExit):
+                while True:
+                    engine.step(timeout=0.1)
+            engine.executor.shutdown()
+
+        @fresh_metrics
+        def test_async_poll_engine(self):
+            import asyncio
+
+            pages = []
+            for name in ('test_status_2.html', 'test_status_3.html'):
+                with open(name) as fp:
+                    pages.append(fp.read())
+            pages.append(pages[-1])  # unchanged
+            expected = FakeAccount(pages=pages)
+            expected = [expected.collect() for i in pages]
+
+            class StoppingAccount(FakeAccount):
+                def fetch_page(self):
+                    if len(self.pages) == 1:
+                        engine.stop()
+                    return super().fetch_page()
+
+            account = StoppingAccount(pages=pages)
+            engine = AsyncPollEngine([account])
+            with mock.patch.object(
+                    account.schedule, 'next_interval', return_value=0.01):
+                asyncio.run(engine.run())
+            self.assertEqual(account.published, expected)
+            self.assertFalse(engine.gave_up)
+
+            # Failing for too long: stop, and give up.
+            account = FakeAccount(pages=[LoginError('x')])
+            account.schedule.failing_since = time.time() - MAX_FAIL_TIME - 1
+            engine = AsyncPollEngine([account])
+            asyncio.run(engine.run())
+            self.assertTrue(engine.gave_up)
+
+        def test_poll_schedule(self):
+            schedule = PollSchedule('E123456')
+            schedule.jitter = 0
+            day = datetime.datetime(2025, 1, 15, 12, 0, 0)
+            night = datetime.datetime(2025, 1, 16, 3, 0, 0)
+
+            self.assertEqual(schedule.next_interval(day), SLEEP_AFTER_FETCH)
+
+            # Only the 24H autotest: nothing happening.
+            schedule.observe([AlarmRecord(
+                datetime=day, event='24H', group='', sector='0',
+                extra='AUTOTEST (Test)')])
+            self.assertEqual(schedule.next_interval(day), SLEEP_AFTER_FETCH)
+
+            # Burglary: poll fast for a while.
+            schedule.observe([AlarmRecord(
+                datetime=day, event='INB', group='1034', sector='0',
+                extra='INBRAAK   GBM RAAM KANTOOR (Inbraak)')])
+            self.assertEqual(schedule.next_interval(day), POLL_INTERVAL_MIN)
+            later = day + datetime.timedelta(seconds=POLL_ACTIVE_PERIOD - 1)
+            self.assertEqual(schedule.next_interval(later), POLL_INTERVAL_MIN)
+
+            # And back off again.
+            later += datetime.timedelta(seconds=2)
+            self.assertEqual(
+                schedule.next_interval(later), 2 * POLL_INTERVAL_MIN)
+            for i in range(10):
+                schedule.next_interval(later)
+            self.assertEqual(schedule.next_interval(later), SLEEP_AFTER_FETCH)
+            for i in range(10):
+                schedule.next_interval(night)
+            self.assertEqual(schedule.next_interval(night), POLL_INTERVAL_MAX)
+
+        @fresh_metrics
+        def test_poll_schedule_failures(self):
+            import requests
+
+            schedule = FakeSchedule('E123456')
+            self.assertEqual(classify_failure(LoginError('x')), 'auth')
+            self.assertEqual(classify_failure(PortalError('x')), 'network')
+            self.assertEqual(
+                classify_failure(requests.ConnectionError('x')), 'network')
+            self.assertEqual(classify_failure(IndexError('x')), 'parse')
+
+            # Network failures back off from RETRY_BACKOFF_MIN.
+            delays = [
+                schedule.failed(requests.Timeout('x'))
+                for i in range(CIRCUIT_MAX_FAILURES - 1)]
+            for n, delay in enumerate(delays):
+                full = min(SLEEP_AFTER_FAIL, RETRY_BACKOFF_MIN * 2 ** n)
+                self.assertTrue(full / 2 <= delay <= full, (n, delay))
+            self.assertEqual(schedule.notices, [])
+
+            # Then the circuit opens, once.
+            delay = schedule.failed(requests.Timeout('x'))
+            self.assertTrue(
+                CIRCUIT_OPEN_TIME / 2 <= delay <= CIRCUIT_OPEN_TIME, delay)
+            self.assertTrue(schedule.circuit_open)
+            self.assertEqual(len(schedule.notices), 1)
+            self.assertIn('network', schedule.notices[0])
+            # Failed probes: open for longer, no new notice.
+            for i in range(10):
+                delay = schedule.failed(LoginError('x'))
+            self.assertTrue(MAX_FAIL_TIME / 2 <= delay <= MAX_FAIL_TIME)
+            self.assertEqual(len(schedule.notices), 1)
+
+            # The probe succeeds: closed again.
+            schedule.succeeded()
+            self.assertFalse(schedule.circuit_open)
+            self.assertEqual(schedule.failures, 0)
+            self.assertEqual(len(schedule.notices), 2)
+            self.assertIn('reachable again', schedule.notices[1])
+
+            # Login failures back off from SLEEP_AFTER_FAIL.
+            delays = [schedule.failed(LoginError('x')) for i in range(3)]
+            for n, delay in enumerate(delays):
+                full = min(CIRCUIT_OPEN_TIME, SLEEP_AFTER_FAIL * 2 ** n)
+                self.assertTrue(full / 2 <= delay <= full, (n, delay))
+            self.assertTrue(
+                SLEEP_AFTER_FAIL / 2 <= delays[0] < CIRCUIT_OPEN_TIME / 2 <=
+                delays[2], delays)
+            schedule.succeeded()
+            self.assertEqual(len(schedule.notices), 2)
+
+            # Parse failures (our bugs) back off the same way, but never
+            # open the circuit, nor count towards it.
+            delays = [
+                schedule.failed(IndexError('x'))
+                for i in range(2 * CIRCUIT_MAX_FAILURES)]
+            for n, delay in enumerate(delays):
+                full = min(CIRCUIT_OPEN_TIME, SLEEP_AFTER_FAIL * 2 ** n)
+                self.assertTrue(full / 2 <= delay <= full, (n, delay))
+            self.assertFalse(schedule.circuit_open)
+            self.assertEqual(schedule.failures, 0)
+            self.assertEqual(
+                schedule.parse_failures, 2 * CIRCUIT_MAX_FAILURES)
+            self.assertEqual(len(schedule.notices), 2)
+            for i in range(CIRCUIT_MAX_FAILURES - 1):
+                schedule.failed(requests.Timeout('x'))
+            self.assertFalse(schedule.circuit_open)
+
+        @fresh_metrics
+        def test_circuit_state_file(self):
+            from tempfile import TemporaryDirectory
+
+            with TemporaryDirectory() as tmpdir:
+                state_file = os.path.join(tmpdir, 'cache.circuit')
+                schedule = FakeSchedule('E123456', state_file=state_file)
+                self.assertFalse(schedule.circuit_open)
+                for i in range(CIRCUIT_MAX_FAILURES):
+                    schedule.failed(LoginError('x'))
+                self.assertTrue(schedule.circuit_open)
+                self.assertEqual(len(schedule.notices), 1)
+                self.assertTrue(os.path.exists(state_file))
+
+                # Restarted (given up) during the outage: still open, and
+                # no new notice.
+                schedule = FakeSchedule('E123456', state_file=state_file)
+                self.assertTrue(schedule.circuit_open)
+                for i in range(CIRCUIT_MAX_FAILURES + 1):
+                    schedule.failed(LoginError('x'))
+                self.assertEqual(schedule.notices, [])
+
+                schedule.succeeded()
+                self.assertFalse(schedule.circuit_open)
+                self.assertEqual(len(schedule.notices), 1)
+                self.assertIn('reachable again', schedule.notices[0])
+                self.assertFalse(os.path.exists(state_file))
+                schedule = FakeSchedule('E123456', state_file=state_file)
+                self.assertFalse(schedule.circuit_open)
+
+        @fresh_metrics
+        def test_health_circuit_open(self):
+            schedule = FakeSchedule('E123456')
+            schedule.succeeded()
+            started = time.time()
+            self.assertTrue(health_check(started)[0])
+            self.assertFalse(
+                health_check(started + HEALTH_MAX_AGE + 1)[0])
+
+            # The portal goes down, for long: the circuit opens and
+            # probes come every MAX_FAIL_TIME (> HEALTH_MAX_AGE).
+            for i in range(CIRCUIT_MAX_FAILURES + 10):
+                delay = schedule.failed(LoginError('x'))
+            self.assertTrue(schedule.circuit_open)
+            self.assertEqual(len(schedule.notices), 1)
+            failed = time.time()
+            retry = METRICS.latest('log2slack_retry_timestamp_seconds')
+            self.assertTrue(failed < retry <= failed + delay + 1)
+
+            # Past HEALTH_MAX_AGE since the last success, and waiting
+            # for the probe: still alive, no restart.
+            healthy, message = health_check(started + HEALTH_MAX_AGE + 1)
+            self.assertTrue(healthy, message)
+            self.assertIn('failing', message)
+            self.assertTrue(health_check(retry + HEALTH_MAX_AGE)[0])
+            # But not if the probe never happens.
+            self.assertFalse(health_check(retry + HEALTH_MAX_AGE + 1)[0])
+
+        def test_metrics(self):
+            from urllib.error import HTTPError
+            from urllib.request import urlopen
+
+            metrics = Metrics()
+            metrics.inc('records_total', 2, account='E1')
+            metrics.inc('records_total', account='E1')
+            metrics.set('queue_depth', 5)
+            metrics.observe('send_seconds', 0.3, account='E1')
+            metrics.observe('send_seconds', 100, account='E1')
+            self.assertEqual(metrics.get('records_total', account='E1'), 3)
+            text = metrics.render()
+            self.assertIn('# TYPE records_total counter\n', text)
+            self.assertIn('records_total{account="E1"} 3\n', text)
+            self.assertIn('queue_depth 5\n', text)
+            self.assertIn(
+                'send_seconds_bucket{account="E1",le="0.25"} 0\n', text)
+            self.assertIn(
+                'send_seconds_bucket{account="E1",le="0.5"} 1\n', text)
+            self.assertIn(
+                'send_seconds_bucket{account="E1",le="+Inf"} 2\n', text)
+            self.assertIn('send_seconds_count{account="E1"} 2\n', text)
+
+            server = start_metrics_server(0)
+            url = f'http://127.0.0.1:{server.server_port}'
+            try:
+                METRICS.set(
+                    'log2slack_last_success_timestamp_seconds', time.time(),
+                    account='E1')
+                with urlopen(f'{url}/healthz') as ret:
+                    self.assertEqual(ret.status, 200)
+                with urlopen(f'{url}/metrics') as ret:
+                    self.assertIn(
+                        b'log2slack_last_success_age_seconds', ret.read())
+
+                METRICS.set(
+                    'log2slack_last_success_timestamp_seconds',
+                    time.time() - HEALTH_MAX_AGE - 1, account='E1')
+                with self.assertRaises(HTTPError) as ctx:
+                    urlopen(f'{url}/healthz')
+                self.assertEqual(ctx.exception.code, 503)
+                ctx.exception.close()
+            finally:
+                server.shutdown()
+                server.server_close()
+                METRICS.gauges.clear()
+
+        def test_lazy_imports(self):
+            import subprocess
+
+            # In a fresh interpreter: this one has imported them already.
+            ret = subprocess.run(
+                [sys.executable, '-c',
+                 'import sys, alert_group_nl_log2slack; '
+                 'print("\\n".join(sys.modules))'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True, check=True, text=True)
+            modules = set(ret.stdout.split())
+            self.assertIn('alert_group_nl_log2slack', modules)
+            for heavy in (
+                    'asyncio', 'bs4', 'http.server', 'phpserialize',
+                    'requests', 'sqlite3'):
+                self.assertNotIn(heavy, modules)
+
+        def test_snapshot_store(self):
+            from tempfile import TemporaryDirectory
+            with open('test_status_3.html') as fp:
+                page = fp.read()
+            # Other page around the same table: same snapshot.
+            other_banner = page.replace('<body>', '<body><p>Hello</p>')
+            other_table = page.replace('17:55:50', '17:55:51')
+
+            with TemporaryDirectory() as tmpdir:
+                store = SnapshotStore(tmpdir)
+                filename = store.save(page)
+                self.assertTrue(filename.endswith('.html.gz'))
+                with gzip.open(filename, 'rt', encoding='utf-8') as fp:
+                    self.assertEqual(fp.read(), page)
+                self.assertIsNone(store.save(other_banner))
+                self.assertIsNone(SnapshotStore(tmpdir).save(page))
+                self.assertIsNotNone(store.save(other_table))
+                self.assertEqual(len(store.snapshots()), 2)
+
+                # Size cap: only the newest one is kept.
+                store.max_bytes = 1
+                store.prune()
+                self.assertEqual(len(store.snapshots()), 1)
+
+        def test_replay(self):
+            from contextlib import redirect_stderr
+            from tempfile import TemporaryDirectory
+            with open('test_status_2.html') as fp:
+                page2 = fp.read()
+            with open('test_status_3.html') as fp:
+                page3 = fp.read()
+
+            with TemporaryDirectory() as tmpdir:
+                store = SnapshotStore(tmpdir)
+                filenames = [store.save(page2), store.save(page3)]
+                filenames.append(os.path.join(tmpdir, 'broken.html'))
+                with open(filenames[-1], 'w') as fp:
+                    fp.write('<html></html>')
+                for n, filename in enumerate(filenames):
+                    os.utime(filename, (1000 + n, 1000 + n))
+                with open(os.devnull, 'w') as devnull, \
+                        redirect_stderr(devnull):
+                    cycles = list(replay_cycles([tmpdir], max_workers=2))
+                    messages = list(replay([tmpdir], max_workers=2))
+
+            # Per snapshot, in the order saved: the records new in it.
+            first = sorted(parse_logs(page2), key=AlarmRecord.SORT_KEY)
+            second = sorted(
+                set(parse_logs(page3)) - set(first),
+                key=AlarmRecord.SORT_KEY)
+            self.assertTrue(second)
+            self.assertEqual(cycles, [first, second, []])
+            # And the Slack messages posted for them.
+            self.assertEqual(messages, [
+                '\n'.join(str(i) for i in first),
+                '\n'.join(str(i) for i in second)])
+
+        def test_account_skips_unchanged(self):
+            with open('test_status_3.html') as fp:
+                page = fp.read()
+            new_rows = (
+                '<tbody>\n'
+                '<tr class="no-link"><td id="datum">16/01/25</td>'
+                '<td id="datum">---</td><td></td><td></td><td></td></tr>\n'
+                '<tr><td>09:00:00</td><td>0</td><td>7</td><td>UIT</td>'
+                '<td>09:00 Uit</td></tr>\n')
+
+            account = FakeAccount(
+                pages=[page, page.replace('<body>', '<body>\n')])
+            self.assertEqual(len(account.collect()), 6)
+            self.assertEqual(account.collect(), set())
+            self.assertEqual(account.unchanged_polls, 1)
+
+            # Something new on top.
+            account.pages.append(page.replace('<tbody>\n', new_rows))
+            new = account.collect()
+            self.assertEqual(
+                [(i.datetime, i.event) for i in new],
+                [(datetime.datetime(2025, 1, 16, 9, 0), 'ALARM_OFF')])
+            self.assertEqual(account.unchanged_polls, 1)
+
+        def test_slack_usermap(self):
+            from tempfile import TemporaryDirectory
+            pages = {
+                '': (200, {'ok': True, 'members': [
+                    {'id': 'U1', 'name': 'alice',
+                     'profile': {'display_name': 'Alice'}},
+                    {'id': 'U2', 'name': 'bob.b',
+                     'profile': {'display_name': ''}}],
+                    'response_metadata': {'next_cursor': 'page2'}}),
+                'page2': (200, {'ok': True, 'members': [
+                    {'id': 'U3', 'name': 'frank',
+                     'profile': {'display_name': 'Frank'}}],
+                    'response_metadata': {'next_cursor': ''}}),
+            }
+            calls = []
+
+            class FakeUsermap(SlackUsermap):
+                def users_list_page(self, cursor):
+                    calls.append(cursor)
+                    return pages[cursor]
+
+            bearer = patch_global('SLACK_API_BEARER', 'xoxb-test')
+            usermap = patch_global('SLACK_USERMAP', {})
+            with bearer, usermap, TemporaryDirectory() as tmpdir:
+                cache = os.path.join(tmpdir, 'usermap.json')
+                usermaps = FakeUsermap(cache_filename=cache)
+                expected = {'alice': 'U1', 'bob.b': 'U2', 'frank': 'U3'}
+                self.assertEqual(usermaps.get(), expected)
+                self.assertEqual(calls, ['', 'page2'])
+
+                # Second time (restart) from the cache.
+                self.assertEqual(FakeUsermap(cache).get(), expected)
+                self.assertEqual(len(calls), 2)
+
+                usermaps.refresh()
+                self.assertEqual(SLACK_USERMAP, expected)
+                self.assertEqual(len(calls), 4)
+
+        def test_record_compact(self):
+            import pickle
+            dt = datetime.datetime(2023, 3, 14, 8, 27, 42)
+            record = AlarmRecord(
+                datetime=dt, event='ALARM_OFF', group='14', sector='0',
+                extra='UITGESCH. ALICE (Uit)')
+            other = AlarmRecord(
+                dt, ''.join(['ALARM', '_OFF']), '1' + '4', '0',
+                'UITGESCH. ALICE (Uit)')
+            self.assertEqual(record.datetime, dt)
+            self.assertEqual(record, other)
+            self.assertEqual(hash(record), hash(other))
+            self.assertIs(record.event, other.event)  # interned
+            self.assertIs(record.group, other.group)
+            self.assertNotEqual(record, AlarmRecord(
+                dt + datetime.timedelta(seconds=1), 'ALARM_OFF', '14', '0',
+                'UITGESCH. ALICE (Uit)'))
+            self.assertFalse(hasattr(record, '__dict__'))
+            self.assertEqual(pickle.loads(pickle.dumps(record)), record)
+            # Hashed, so immutable.
+            with self.assertRaises(AttributeError):
+                record.extra = 'changed'
+            with self.assertRaises(AttributeError):
+                del record.event
+            self.assertEqual(record, other)
+            # Whole seconds only.
+            self.assertEqual(AlarmRecord(
+                dt.replace(microsecond=999999), 'ALARM_OFF', '14', '0',
+                'UITGESCH. ALICE (Uit)'), record)
+            self.assertEqual(
+                record.timestamp, AlarmRecord.to_timestamp(dt))
+            self.assertEqual(
+                repr(record),
+                "<AlarmRecord{'datetime': datetime.datetime(2023, 3, 14, 8, "
+                "27, 42), 'event': 'ALARM_OFF', 'group': '14', 'sector': '0', "
+                "'extra': 'UITGESCH. ALICE (Uit)'}>")
+            self.assertLess(
+                AlarmRecord.SORT_KEY(record), AlarmRecord.SORT_KEY(
+                    AlarmRecord(dt, 'ALARM_ON', '14', '0', '')))
+
+        def test_alertmobile_session_reuse(self):
+            with open('test_status_3.html') as fp:
+                status_page = fp.read()
+            login_page = '<form><input name="klantnr"></form>'
+            responses = []
+            requests_done = []
+
+            class FakeAlertMobileSession(AlertMobileSession):
+                def new_session(self):
+                    return FakeSession(responses, requests_done)
+
+            session = FakeAlertMobileSession('E123456', 'x')
+            responses.extend([login_page, '', status_page])
+            self.assertEqual(session.fetch_status(), status_page)
+            self.assertEqual(len(requests_done), 3)
+            self.assertEqual(session.logins, 1)
+            self.assertEqual(
+                session.last_bytes, len(status_page.encode('utf-8')))
+
+            # Second cycle: straight to the status page.
+            del requests_done[:]
+            responses.extend([status_page])
+            self.assertEqual(session.fetch_status(), status_page)
+            self.assertEqual(
+                requests_done, [('GET', session.status_url)])
+            self.assertEqual(session.logins, 1)
+
+            # Expired session: login form, log in again, refetch.
+            del requests_done[:]
+            responses.extend([login_page, login_page, '', status_page])
+            self.assertEqual(session.fetch_status(), status_page)
+            self.assertEqual(len(requests_done), 4)
+            self.assertEqual(session.logins, 2)
+
+            # Or some other page: the same.
+            responses.extend([
+                '<p>Sessie verlopen</p>', login_page, '', status_page])
+            self.assertEqual(session.fetch_status(), status_page)
+            self.assertEqual(session.logins, 3)
+
+            # Still no history table after logging in: an error, not a
+            # status page without rows.
+            header_only = status_page[:status_page.index('<table')]
+            responses.extend([header_only, login_page, '', header_only])
+            with self.assertRaises(PortalError):
+                session.fetch_status()
+            self.assertEqual(session.logins, 4)
+            self.assertIsNone(session.session)
+            responses.extend([login_page, '', login_page])
+            with self.assertRaises(LoginError):
+                session.fetch_status()
+
+        def test_read_status_page(self):
+            with open('test_status_1.html', 'rb') as fp:
+                data = fp.read()
+            table_end = data.index(b'</table>') + 8
+
+            # A short tail is read too, to keep the connection (odd sized
+            # chunks throughout).
+            ret = FakeResponse(data, chunk_size=7)
+            text, received, first_row = read_status_page(
+                ret, time.perf_counter())
+            self.assertEqual(text, data.decode('utf-8'))
+            self.assertEqual(received, len(data))
+            self.assertIsNotNone(first_row)
+
+            # A long tail is not.
+            ret = FakeResponse(data + (b' ' * 100000), chunk_size=7)
+            with patch_global('PORTAL_DRAIN_MAX', 0):
+                text, received, first_row = read_status_page(
+                    ret, time.perf_counter())
+            self.assertLess(received, table_end + 14)
+            self.assertEqual(
+                html_table_to_dicts(text), html_table_to_dicts(data.decode()))
+
+            # No history table: everything, without first row.
+            ret = FakeResponse(
+                b'<form><input name="klantnr"></form>', chunk_size=7)
+            text, received, first_row = read_status_page(ret, 0)
+            self.assertEqual(text, '<form><input name="klantnr"></form>')
+            self.assertIsNone(first_row)
+
+        def test_stub_server(self):
+            import tempfile
+            from stubserver import StubServer
+
+            with open('test_status_3.html') as fp:
+                status_page = fp.read()
+            # One rate limit, to go through the retry.
+            stub = StubServer(
+                [status_page], credentials=('E123456', make_klant_gecrypt(
+                    'secret')), slack_responses=[429]).start()
+            portal = patch_global('ALERTMOBILE_URL', stub.portal_url)
+            lookback = patch_global(
+                'PUBLISH_LOOKBACK', datetime.timedelta(days=36500))
+            no_sleep = mock.patch('time.sleep')
+            try:
+                with portal, lookback, no_sleep, \
+                        tempfile.TemporaryDirectory() as tmpdir:
+                    account = Account(
+                        'E123456', 'secret', stub.slack_url,
+                        cache_filename=os.path.join(tmpdir, 'cache'))
+                    account.poll()
+                    account.poll()
+                    session = _alertmobile_sessions['E123456']
+                    # Transferred gzipped.
+                    self.assertLess(
+                        session.last_bytes, len(status_page) // 2)
+            finally:
+                reset_sessions('E123456')
+                stub.stop()
+
+            # Logged in once, bounced once, then two status pages.
+            self.assertEqual(stub.stats['login'], 1)
+            self.assertEqual(stub.stats['bounce'], 1)
+            self.assertEqual(stub.stats['status'], 2)
+            self.assertEqual(stub.stats['slack_429'], 1)
+            messages = '\n'.join(stub.slack_messages).split('\n')
+            self.assertEqual(
+                messages, [str(i) for i in sorted(
+                    parse_logs(status_page), key=AlarmRecord.SORT_KEY)])
+
         def test_record_alarm_off_old(self):
             self.assertEqual(
                 str(AlarmRecord(
@@ -1113,6 +4527,37 @@ def test():
                 SLACK_NO_MENTION_USERS = orig
                 SLACK_USERMAP = orig2
 
+        def test_record_alarm_mention_cache(self):
+            record = AlarmRecord(
+                datetime=datetime.datetime(2025, 1, 15, 8, 29, 32),
+                event='ALARM_OFF', group='8', sector='0',
+                extra='UITGESCH. FRANK (08:28 Uit)')
+            with patch_global('SLACK_USERMAP', {'frank': 'U1'}):
+                self.assertEqual(
+                    str(record),
+                    '2025-01-15 08:29:32: ALARM_OFF (G8/S0): by <@U1>')
+            # A refreshed usermap invalidates the cached mentions.
+            with patch_global('SLACK_USERMAP', {'frank': 'U2'}) as usermap:
+                self.assertEqual(
+                    str(record),
+                    '2025-01-15 08:29:32: ALARM_OFF (G8/S0): by <@U2>')
+                # Changed in place: only after clear().
+                usermap['frank'] = 'U3'
+                self.assertIn('<@U2>', str(record))
+                MENTIONS.clear()
+                self.assertIn('<@U3>', str(record))
+
+            # Not quite the format: left alone.
+            record = AlarmRecord(
+                datetime=datetime.datetime(2025, 1, 15, 8, 29, 32),
+                event='ALARM_OFF', group='8', sector='0',
+                extra='UITGESCH. FRANK (08:28Uit)')
+            self.assertEqual(record.username, None)
+            self.assertEqual(
+                str(record),
+                '2025-01-15 08:29:32: ALARM_OFF (G8/S0): '
+                'UITGESCH. FRANK (08:28Uit)')
+
         def test_record_alarm_no_mention(self):
             global SLACK_NO_MENTION_USERS
             orig = SLACK_NO_MENTION_USERS
@@ -1191,14 +4636,43 @@ if __name__ == '__main__':
         print('# alert_group_nl_log2slack')
         for varname in (
                 'ALERTMOBILE_URL MAX_FAIL_TIME '
-                'SLEEP_AFTER_FETCH SLEEP_AFTER_FAIL'.split()):
+                'SLEEP_AFTER_FETCH SLEEP_AFTER_FAIL RETRY_BACKOFF_MIN '
+                'CIRCUIT_MAX_FAILURES CIRCUIT_OPEN_TIME POLL_INTERVAL_MIN '
+                'POLL_INTERVAL_MAX LEDGER_FILE SNAPSHOT_DIR HISTORY_DB '
+                'JSONL_FILE SYSLOG_ADDRESS '
+                'ANALYTICS_FILE DIGEST_PERIOD METRICS_PORT '
+                'ACCOUNTS_FILE POLL_WORKERS'.split()):
             value = globals()[varname]
             print(f'# - {varname} = {value}')
 
-        SLACK_USERMAP = make_slack_usermap()
+        usermaps = SlackUsermap()
+        SLACK_USERMAP = usermaps.get()
         print(f'# - SLACK_USERMAP = ({len(SLACK_USERMAP)} entries)')
+        usermaps.start_refresh()
 
-        fetch_logs_and_publish_forever()
+        if sys.argv[2:3] == ['--async']:
+            fetch_logs_and_publish_forever_async()
+        else:
+            fetch_logs_and_publish_forever()
+    elif sys.argv[1:2] == ['replay']:
+        # replay [--json] SNAPSHOT_FILE_OR_DIR...
+        args = sys.argv[2:]
+        as_json = ('--json' in args)
+        paths = [i for i in args if i != '--json']
+        # The mentions as published: from the cached users.list, if any.
+        usermap = SlackUsermap().load_cache()
+        if usermap is not None:
+            SLACK_USERMAP = usermap
+        else:
+            print('replay: no SLACK_USERMAP_CACHE, using the default '
+                  'SLACK_USERMAP', file=sys.stderr)
+        for message in replay(paths):
+            if as_json:
+                print(make_slack_message(message))
+            else:
+                print(message)
+    elif sys.argv[1:2] == ['history']:
+        history_main(sys.argv[2:])
     elif sys.argv[1:2] == ['test']:
         from unittest import main
         os.environ['KLANT_NUMMER'] = 'E123456'  # yes, without 0
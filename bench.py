@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for alert_group_nl_log2slack.
+
+Times every stage of the parse pipeline on synthetic status pages of
+various sizes (made from the real page skeleton of test_status_1.html),
+and reports ops/s, rows/s, peak traced allocations and peak RSS.
+
+Usage::
+
+    python3 bench.py                          # all sizes
+    python3 bench.py --sizes 10,1000 --json bench.json
+    python3 bench.py --compare bench.json     # compare against earlier run
+    python3 bench.py --fixtures               # streaming vs. bs4 parser
+    python3 bench.py --memory                 # AlarmRecord memory use
+    python3 bench.py --cycles 50 --sizes 100  # poll cycles against stubs
+    python3 bench.py --format                 # record to message formatting
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+from contextlib import redirect_stdout
+from io import StringIO
+
+import alert_group_nl_log2slack as log2slack
+
+FIXTURES = (
+    'test_status_1.html', 'test_status_2.html',
+    'test_status_3.html', 'test_status_4.html')
+SKELETON = 'test_status_1.html'
+DEFAULT_SIZES = (10, 100, 1000, 10000, 100000)
+USERS = ('ALICE', 'BOB', 'CHARLIE', 'FRANK', 'MANAGR')
+
+ROW = '''\
+<tr>
+<td>{time}</td>
+<td>0</td>
+<td>{group}</td>
+<td><a href="koi_kb.php?mscherm=status&aansluit_nr=E0123456">E0123456</a></td>
+<td>{alrm}</td>
+<td> {text}</td>
+</tr>
+'''
+DATE_ROW = '''\
+<tr class="no-link">
+<td id="datum">{date}</td>
+<td id="datum">---</td>
+<td></td>
+<td></td>
+<td></td>
+<td></td>
+</tr>
+'''
+
+
+def synthetic_events(rng):
+    """
+    Yield lists of (alrm, group, text) rows sharing a timestamp, in the
+    order the portal lists them.
+    """
+    while True:
+        user = rng.choice(USERS)
+        group = str(rng.randint(1, 14))
+        pick = rng.random()
+        if pick < 0.35:
+            yield [('INF', group, f'VOLL. ING {user}'),
+                   ('IN', group, '17:54 In')]
+        elif pick < 0.7:
+            # The INF comes before or after the UIT.
+            rows = [('INF', group, f'UITGESCH. {user}'),
+                    ('UIT', group, '08:28 Uit')]
+            yield rows if rng.random() < 0.8 else rows[::-1]
+        elif pick < 0.9:
+            yield [('INF', '', 'AUTOTEST'), ('24H', '', '10:10 Test')]
+        elif pick < 0.95:
+            yield [('AFW', '', '11-07-23 Bewaking'),
+                   ('AFW', '', '11-07-23 Afwijkende inschakeltijd 02:15')]
+        else:
+            yield [('HER', '1034', 'INBRAAK   GBM RAAM KANTOOR'),
+                   ('INB', '1034', 'INBRAAK   GBM RAAM KANTOOR')]
+
+
+def make_status_page(rows, seed=1, until=None):
+    """
+    Return a status page with (about) the given number of table rows,
+    newest first (ending at until), using the markup of the real page
+    around it.
+    """
+    with open(SKELETON) as fp:
+        skeleton = fp.read()
+    head, rest = skeleton.split('<tbody>', 1)
+    tail = rest.split('</tbody>', 1)[1]
+
+    rng = random.Random(seed)
+    events = synthetic_events(rng)
+    when = until or datetime.datetime(2025, 1, 15, 23, 59, 59)
+    date = None
+    body = []
+    count = 0
+    while count < rows:
+        if when.date() != date:
+            date = when.date()
+            body.append(DATE_ROW.format(date=date.strftime('%d/%m/%y')))
+            count += 1
+        for alrm, group, text in next(events):
+            body.append(ROW.format(
+                time=when.strftime('%H:%M:%S'), group=group, alrm=alrm,
+                text=text))
+            count += 1
+        when -= datetime.timedelta(seconds=rng.randint(60, 6 * 3600))
+
+    return ''.join([head, '<tbody>\n', ''.join(body), '</tbody>', tail])
+
+
+def peak_rss_kib():
+    # ru_maxrss is in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(func, args_list):
+    """
+    Call func once for every args in args_list. Returns the calls per
+    second and the peak traced allocation of the (separate) last call.
+    """
+    t0 = time.perf_counter()
+    for args in args_list[:-1]:
+        func(*args)
+    td = time.perf_counter() - t0
+
+    tracemalloc.start()
+    func(*args_list[-1])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return ((len(args_list) - 1) / td), peak
+
+
+def copy_rows(rows):
+    return [dict(i) for i in rows]
+
+
+def bench_pipeline(size):
+    html_doc = make_status_page(size)
+    repeat = max(3, min(200, 20000 // size)) + 1  # +1 for tracemalloc
+
+    rows = log2slack.html_table_to_dicts(html_doc)
+    dated = log2slack.fix_dicts_datetime(copy_rows(rows))
+    merged = log2slack.fix_dicts_who_did_what(copy_rows(dated))
+    records = log2slack.to_records(merged)
+
+    # The fix_* stages alter their input, so every call gets a copy.
+    stages = (
+        ('html_table_to_dicts', log2slack.html_table_to_dicts,
+         [(html_doc,)] * repeat),
+        ('fix_dicts_datetime', log2slack.fix_dicts_datetime,
+         [(copy_rows(rows),) for i in range(repeat)]),
+        ('fix_dicts_who_did_what', log2slack.fix_dicts_who_did_what,
+         [(copy_rows(dated),) for i in range(repeat)]),
+        ('to_records', log2slack.to_records, [(merged,)] * repeat),
+        ('AlarmRecord.__str__', (lambda records: [str(i) for i in records]),
+         [(records,)] * repeat),
+        ('parse_logs', (lambda html_doc: list(log2slack.parse_logs(html_doc))),
+         [(html_doc,)] * repeat),
+    )
+
+    results = []
+    for name, func, args_list in stages:
+        ops, peak = measure(func, args_list)
+        results.append({
+            'size': size, 'stage': name, 'rows': len(rows),
+            'records': len(records), 'ops_per_sec': ops,
+            'rows_per_sec': ops * len(rows), 'peak_alloc_bytes': peak,
+            'peak_rss_kib': peak_rss_kib()})
+    return results
+
+
+def bench_fixtures(repeat=200):
+    print('# html_table_to_dicts: streaming vs. bs4')
+    for filename in FIXTURES:
+        with open(filename) as fp:
+            data = fp.read()
+        for func in (
+                log2slack.html_table_to_dicts,
+                log2slack.html_table_to_dicts_bs4):
+            ops, peak = measure(func, [(data,)] * (repeat + 1))
+            print(
+                f'{filename}  {func.__name__:24s}  '
+                f'{ops:10.1f} ops/s  {peak / 1024:8.1f} KiB peak')
+
+
+# The AlarmRecord as it was before it got compact.
+NamedTupleAlarmRecord = namedtuple(
+    'NamedTupleAlarmRecord', 'datetime event group sector extra')
+
+
+def retained_bytes(func):
+    """
+    Return the result of func and the size of the allocations it kept.
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = func()
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, retained
+
+
+def bench_records_memory(sizes):
+    print('# memory retained by a list of records')
+    for size in sizes:
+        records = list(log2slack.parse_logs(make_status_page(size)))
+        fields = [
+            (i.datetime.timetuple()[:6], i.event, i.group, i.sector, i.extra)
+            for i in records]
+
+        for cls in (NamedTupleAlarmRecord, log2slack.AlarmRecord):
+            # Fresh (not shared) values for every field, like the parser
+            # makes them.
+            made, retained = retained_bytes(lambda: [
+                cls(datetime.datetime(*dt), event.encode().decode(),
+                    group.encode().decode(), sector.encode().decode(),
+                    extra.encode().decode())
+                for dt, event, group, sector, extra in fields])
+            del made
+            print(
+                f'{len(records):7d} records  {cls.__name__:22s}  '
+                f'{retained / 1024:10.1f} KiB  '
+                f'{retained / len(records):6.0f} bytes/record')
+
+
+def bench_cycles(count, sizes):
+    """
+    Time full poll cycles (fetch, parse, publish) of an Account against
+    the local stub portal and Slack webhook, with a new page every
+    cycle.
+    """
+    from stubserver import StubServer
+
+    print('# full poll cycles against the stub server')
+    for size in sizes:
+        seeds = iter(range(count))
+        stub = StubServer(lambda: make_status_page(
+            size, seed=next(seeds),
+            until=datetime.datetime.now().replace(microsecond=0))).start()
+        log2slack.ALERTMOBILE_URL = stub.portal_url
+        try:
+            # The publisher is chatty, keep its output out of the results.
+            with tempfile.TemporaryDirectory() as tmpdir, \
+                    redirect_stdout(StringIO()):
+                account = log2slack.Account(
+                    'E123456', 'secret', stub.slack_url,
+                    cache_filename=os.path.join(tmpdir, 'cache'))
+                account.poll()  # login and the "gebruiker_wijzigen" bounce
+                session = log2slack._alertmobile_sessions['E123456']
+                timings = []
+                page_bytes = []
+                first_rows = []
+                for i in range(count - 1):
+                    t0 = time.perf_counter()
+                    account.poll()
+                    timings.append(time.perf_counter() - t0)
+                    page_bytes.append(session.last_bytes)
+                    first_rows.append(session.last_first_row)
+        finally:
+            log2slack.reset_sessions('E123456')
+            stub.stop()
+
+        timings.sort()
+        print(
+            f'{size:7d} rows  {len(timings):5d} cycles  '
+            f'p50 {timings[len(timings) // 2] * 1000:8.1f} ms  '
+            f'p95 {timings[int(len(timings) * 0.95)] * 1000:8.1f} ms  '
+            f'max {timings[-1] * 1000:8.1f} ms  '
+            f'{sum(page_bytes) / len(page_bytes) / 1024:8.1f} KiB/cycle  '
+            f'first row {sum(first_rows) / len(first_rows) * 1000:6.1f} ms  '
+            f'{len(stub.slack_messages)} slack posts')
+
+
+def legacy_format(record, no_mention, usermap):
+    """
+    AlarmRecord.__str__ as it was before the rules were precompiled: a
+    startswith/endswith chain and a list scan for the mentions.
+    """
+    def mention(username):
+        if username in no_mention:
+            return username
+        slack_userid = usermap.get(username.lower())
+        if not slack_userid:
+            return username
+        return f'<@{slack_userid}>'
+
+    message = (
+        '{0.datetime_str}: {0.event} (G{0.group}/S{0.sector})'
+        .format(record).rstrip())
+    info = record.extra
+    if record.event == 'ALARM_ON' and info.startswith('VOLL. ING '):
+        if info.endswith(' (In)'):
+            info = f'by {mention(info[10:-5].lower())}'
+        elif info.endswith(' In)') and info[-11:-9] == ' (':
+            info = f'by {mention(info[10:-11].lower())}'
+    elif record.event == 'ALARM_OFF' and info.startswith('UITGESCH. '):
+        if info.endswith(' (Uit)'):
+            info = f'by {mention(info[10:-6].lower())}'
+        elif info.endswith(' Uit)') and info[-12:-10] == ' (':
+            info = f'by {mention(info[10:-12].lower())}'
+    elif record.event == '24H' and info == 'AUTOTEST (Test)':
+        info = '(autotest)'
+    elif record.event not in record.NORMAL_EVENTS:
+        info += ' <-- <!channel>'
+    if info:
+        message += f': {info}'
+    return message
+
+
+def bench_format(sizes, min_time=1.0):
+    print('# record to Slack message formatting')
+    # A sizable workspace, with most of the users not to be mentioned.
+    usermap = dict((f'user{i}', f'U{i:08d}') for i in range(2000))
+    usermap.update((i.lower(), f'U{i}') for i in USERS[:3])
+    no_mention = [f'user{i}' for i in range(500)] + [USERS[3].lower()]
+    orig = log2slack.SLACK_USERMAP, log2slack.SLACK_NO_MENTION_USERS
+    log2slack.SLACK_USERMAP = usermap
+    log2slack.SLACK_NO_MENTION_USERS = frozenset(no_mention)
+    try:
+        for size in sizes:
+            records = list(log2slack.parse_logs(make_status_page(size)))
+            assert [str(i) for i in records] == [
+                legacy_format(i, no_mention, usermap) for i in records]
+            for name, func in (
+                    ('legacy', (lambda i: legacy_format(
+                        i, no_mention, usermap))),
+                    ('AlarmRecord.__str__', str)):
+                count = 0
+                t0 = time.perf_counter()
+                while True:
+                    for record in records:
+                        func(record)
+                    count += len(records)
+                    td = time.perf_counter() - t0
+                    if td >= min_time:
+                        break
+                print(
+                    f'{len(records):7d} records  {name:20s}  '
+                    f'{count / td:10.0f} messages/s')
+    finally:
+        log2slack.SLACK_USERMAP, log2slack.SLACK_NO_MENTION_USERS = orig
+
+
+def git_version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous=None):
+    before = {}
+    if previous is not None:
+        before = dict(
+            ((i['size'], i['stage']), i) for i in previous['results'])
+
+    for result in results:
+        line = (
+            f'{result["size"]:7d} rows  {result["stage"]:24s}  '
+            f'{result["ops_per_sec"]:10.1f} ops/s  '
+            f'{result["rows_per_sec"]:12.0f} rows/s  '
+            f'{result["peak_alloc_bytes"] / 1024:10.1f} KiB peak  '
+            f'{result["peak_rss_kib"] / 1024:7.1f} MiB rss')
+        old = before.get((result['size'], result['stage']))
+        if old is not None:
+            line += f'  x{result["ops_per_sec"] / old["ops_per_sec"]:.2f}'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--sizes', default=','.join(str(i) for i in DEFAULT_SIZES),
+        help='comma separated table row counts')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='compare to this earlier --json')
+    parser.add_argument(
+        '--fixtures', action='store_true',
+        help='compare the streaming and bs4 parsers on the fixtures')
+    parser.add_argument(
+        '--memory', action='store_true',
+        help='compare the memory use of the AlarmRecords')
+    parser.add_argument(
+        '--cycles', type=int,
+        help='time this many poll cycles against the stub server')
+    parser.add_argument(
+        '--format', action='store_true',
+        help='compare the record formatting to the legacy one')
+    args = parser.parse_args()
+
+    if args.fixtures:
+        bench_fixtures()
+        return
+    if args.memory:
+        bench_records_memory([int(i) for i in args.sizes.split(',')])
+        return
+    if args.cycles:
+        bench_cycles(args.cycles, [int(i) for i in args.sizes.split(',')])
+        return
+    if args.format:
+        bench_format([int(i) for i in args.sizes.split(',')])
+        return
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as fp:
+            previous = json.load(fp)
+        print(f'# compared to {previous.get("version")} (xN = speedup)')
+
+    results = []
+    for size in [int(i) for i in args.sizes.split(',')]:
+        size_results = bench_pipeline(size)
+        print_results(size_results, previous)
+        results.extend(size_results)
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump({
+                'version': git_version(),
+                'python': sys.version.split()[0],
+                'when': datetime.datetime.now().isoformat(),
+                'results': results}, fp, indent=2)
+            fp.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the alertmobile portal and the Slack webhook.
+
+Serves a fake koi_kb.php (login form, login POST, the
+"gebruiker_wijzigen" bounce after logging in, and status pages from the
+fixtures or generated ones, gzipped if asked for) and a fake Slack
+webhook with configurable latency, errors and rate limits. Point the
+publisher at it to run it offline::
+
+    python3 stubserver.py --port 8080 --rows 200 --slack-429 0.05 &
+    ALERTMOBILE_URL=http://127.0.0.1:8080/koi_kb.php \\
+    SLACK_WEBHOOK_URL=http://127.0.0.1:8080/slack \\
+    KLANT_NUMMER=E123456 KLANT_CODE=secret POLL_INTERVAL_MIN=1 \\
+        python3 alert_group_nl_log2slack.py publish
+"""
+import argparse
+import datetime
+import gzip
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from uuid import uuid4
+
+FIXTURES = (
+    'test_status_1.html', 'test_status_2.html',
+    'test_status_3.html', 'test_status_4.html')
+
+LOGIN_PAGE = '''\
+<html><body>
+<form method="post" action="koi_kb.php">
+<input type="text" name="klantnr">
+<input type="password" name="klantcode">
+<input type="hidden" name="gecrypt">
+</form>
+</body></html>
+'''
+BOUNCE_PAGE = '''\
+<html><body>
+<a href="koi_kb.php?mscherm=gebruiker_wijzigen">Gebruiker wijzigen</a>
+</body></html>
+'''
+WELCOME_PAGE = '<html><body>Welkom</body></html>\n'
+
+
+class StubServer:
+    """
+    The fake portal and webhook, on a ThreadingHTTPServer in a daemon
+    thread. pages is a list of status pages served in turn, or a
+    callable returning the next one.
+
+    Portal sessions are kept by cookie. After every login, the first
+    status GET gets the "gebruiker_wijzigen" bounce (if bounce is set).
+    Sessions expire after expire_after status pages (if set).
+
+    The Slack webhook answers with the status codes in slack_responses
+    first, then with 429 or 500 at the given rates, after a delay of
+    slack_latency seconds. Accepted messages end up in slack_messages.
+    """
+    def __init__(self, pages, port=0, credentials=None, bounce=True,
+                 expire_after=None, slack_latency=0.0, slack_429_rate=0.0,
+                 slack_error_rate=0.0, slack_responses=(), seed=None):
+        self.pages = pages
+        self.credentials = credentials  # (klantnr, gecrypt) or None
+        self.bounce = bounce
+        self.expire_after = expire_after
+        self.slack_latency = slack_latency
+        self.slack_429_rate = slack_429_rate
+        self.slack_error_rate = slack_error_rate
+        self.slack_responses = list(slack_responses)
+        self.slack_messages = []
+        self.stats = Counter()
+        # cookie => 'bounce', status pages left (0: no limit), or -1 if
+        # not logged in
+        self.sessions = {}
+        self.page_index = 0
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(
+            ('127.0.0.1', port), make_handler(self))
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    @property
+    def portal_url(self):
+        return f'{self.url}/koi_kb.php'
+
+    @property
+    def slack_url(self):
+        return f'{self.url}/slack'
+
+    def start(self):
+        threading.Thread(
+            target=self.server.serve_forever, name='stubserver',
+            daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def next_page(self):
+        if callable(self.pages):
+            return self.pages()
+        page = self.pages[self.page_index % len(self.pages)]
+        self.page_index += 1
+        return page
+
+    def portal_get(self, cookie, query):
+        with self.lock:
+            self.stats['portal_get'] += 1
+            left = self.sessions.get(cookie, -1)
+            if query.get('mscherm') != ['status'] or left == -1:
+                return LOGIN_PAGE
+            if left == 'bounce':
+                self.stats['bounce'] += 1
+                left = self.expire_after or 0
+                self.sessions[cookie] = left
+                return BOUNCE_PAGE
+            if self.expire_after:
+                if left <= 1:
+                    # Served the last one, next time the login form.
+                    self.stats['expired'] += 1
+                    del self.sessions[cookie]
+                else:
+                    self.sessions[cookie] = left - 1
+            self.stats['status'] += 1
+            return self.next_page()
+
+    def portal_post(self, cookie, form):
+        with self.lock:
+            self.stats['portal_post'] += 1
+            login = (
+                form.get('klantnr', [''])[0], form.get('gecrypt', [''])[0])
+            if self.credentials is not None and login != self.credentials:
+                self.stats['login_failed'] += 1
+                self.sessions[cookie] = -1
+                return LOGIN_PAGE
+            self.stats['login'] += 1
+            self.sessions[cookie] = (
+                'bounce' if self.bounce else (self.expire_after or 0))
+            return WELCOME_PAGE
+
+    def slack_post(self, body):
+        time.sleep(self.slack_latency)
+        with self.lock:
+            self.stats['slack_post'] += 1
+            if self.slack_responses:
+                status = self.slack_responses.pop(0)
+            else:
+                pick = self.rng.random()
+                if pick < self.slack_429_rate:
+                    status = 429
+                elif pick < self.slack_429_rate + self.slack_error_rate:
+                    status = 500
+                else:
+                    status = 200
+            self.stats[f'slack_{status}'] += 1
+            if status == 200:
+                message = json.loads(body)
+                if 'blocks' in message:
+                    message = message['blocks'][0]['text']
+                self.slack_messages.append(message['text'])
+        return status
+
+
+def make_handler(stub):
+    class StubHandler(BaseHTTPRequestHandler):
+        new_cookie = None
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == '/koi_kb.php':
+                cookie = self.get_cookie()
+                self.respond(
+                    200, stub.portal_get(cookie, parse_qs(url.query)),
+                    cookie)
+            else:
+                self.respond(404, 'Not found\n')
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length).decode('utf-8')
+            if url.path == '/koi_kb.php':
+                cookie = self.get_cookie()
+                self.respond(
+                    200, stub.portal_post(cookie, parse_qs(body)), cookie)
+            elif url.path == '/slack':
+                status = stub.slack_post(body)
+                self.respond(status, 'ok' if status == 200 else 'error')
+            else:
+                self.respond(404, 'Not found\n')
+
+        def get_cookie(self):
+            for part in self.headers.get('Cookie', '').split(';'):
+                key, sep, value = part.strip().partition('=')
+                if key == 'PHPSESSID' and value:
+                    return value
+            self.new_cookie = uuid4().hex
+            return self.new_cookie
+
+        def respond(self, status, body, cookie=None):
+            body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body)
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            if cookie is not None and cookie == self.new_cookie:
+                self.send_header('Set-Cookie', f'PHPSESSID={cookie}')
+            if status == 429:
+                self.send_header('Retry-After', '1')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def read_pages(filenames):
+    pages = []
+    for filename in filenames:
+        with open(filename) as fp:
+            pages.append(fp.read())
+    return pages
+
+
+def make_fresh_pages(rows, new_every):
+    """
+    Return a callable making status pages with rows ending now, with
+    new events every new_every seconds.
+    """
+    from bench import make_status_page
+
+    cache = {}
+
+    def fresh_page():
+        now = time.time()
+        key = int(now // new_every) if new_every else now
+        if key not in cache:
+            cache.clear()
+            cache[key] = make_status_page(
+                rows, seed=key,
+                until=datetime.datetime.fromtimestamp(int(now)))
+        return cache[key]
+
+    return fresh_page
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument(
+        '--pages', nargs='+', default=FIXTURES,
+        help='status pages to serve in turn (default: the fixtures)')
+    parser.add_argument(
+        '--rows', type=int,
+        help='serve generated pages of ROWS rows, ending now, instead')
+    parser.add_argument(
+        '--new-every', type=float, default=60,
+        help='seconds between new generated pages (with --rows)')
+    parser.add_argument(
+        '--expire-after', type=int,
+        help='expire the portal session after this many status pages')
+    parser.add_argument(
+        '--no-bounce', action='store_true',
+        help='skip the "gebruiker_wijzigen" page after logging in')
+    parser.add_argument('--slack-latency', type=float, default=0.0)
+    parser.add_argument('--slack-429', type=float, default=0.0)
+    parser.add_argument('--slack-errors', type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.rows:
+        pages = make_fresh_pages(args.rows, args.new_every)
+    else:
+        pages = read_pages(args.pages)
+
+    stub = StubServer(
+        pages, port=args.port, bounce=not args.no_bounce,
+        expire_after=args.expire_after, slack_latency=args.slack_latency,
+        slack_429_rate=args.slack_429, slack_error_rate=args.slack_errors)
+    print(f'# portal on {stub.portal_url}, slack webhook on {stub.slack_url}')
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f'# {dict(stub.stats)}, {len(stub.slack_messages)} messages')
+
+
+if __name__ == '__main__':
+    main()